@@ -0,0 +1,213 @@
+#%%
+import time
+import tracemalloc
+import math
+import random
+import osm as o
+
+
+def makeSyntheticOverpassData(nrWays, nodesPerWay=5, nrFreeNodes=None, seed=0):
+    """
+        Builds a payload shaped like the response to `(._;>;); out geom;`:
+        ways with inline geometry plus all their member nodes, and some free nodes.
+    """
+    rand = random.Random(seed)
+    if nrFreeNodes is None:
+        nrFreeNodes = nrWays
+
+    elements = []
+    nodeId = 0
+    for wayId in range(nrWays):
+        lon0 = rand.uniform(11.0, 12.0)
+        lat0 = rand.uniform(48.0, 49.0)
+        nodes = []
+        geometry = []
+        for i in range(nodesPerWay - 1):
+            lon = lon0 + 0.0001 * (i % 2)
+            lat = lat0 + 0.0001 * (i // 2)
+            elements.append({"type": "node", "id": nodeId, "lat": lat, "lon": lon})
+            nodes.append(nodeId)
+            geometry.append({"lat": lat, "lon": lon})
+            nodeId += 1
+        nodes.append(nodes[0])
+        geometry.append(geometry[0])
+        elements.append({
+            "type": "way", "id": wayId, "nodes": nodes, "geometry": geometry,
+            "tags": {"building": "yes"}
+        })
+
+    for _ in range(nrFreeNodes):
+        elements.append({
+            "type": "node", "id": nodeId,
+            "lat": rand.uniform(48.0, 49.0), "lon": rand.uniform(11.0, 12.0),
+            "tags": {"natural": "tree"}
+        })
+        nodeId += 1
+
+    return {"elements": elements}
+
+
+def makeSyntheticRelation(nrMembers, nrInners=100, seed=0):
+    """
+        A multipolygon-relation whose outer ring, a circle, is split into `nrMembers` ways,
+        shuffled and partly reversed - the way large lakes and forests come out of overpass.
+    """
+    rand = random.Random(seed)
+    angles = [2 * math.pi * i / nrMembers for i in range(nrMembers)] + [0]
+    circle = [{"lon": 11.5 + 0.5 * math.cos(a), "lat": 48.5 + 0.5 * math.sin(a)} for a in angles]
+    members = []
+    for i in range(nrMembers):
+        geometry = circle[i:i + 2]
+        if rand.random() < 0.5:
+            geometry = geometry[::-1]
+        members.append({"type": "way", "ref": i, "role": "outer", "geometry": geometry})
+    for i in range(nrInners):
+        lon = rand.uniform(11.2, 11.8)
+        lat = rand.uniform(48.2, 48.8)
+        square = [(lon, lat), (lon + 0.001, lat), (lon + 0.001, lat + 0.001), (lon, lat + 0.001), (lon, lat)]
+        geometry = [{"lon": x, "lat": y} for x, y in square]
+        members.append({"type": "way", "ref": nrMembers + i, "role": "inner", "geometry": geometry})
+    rand.shuffle(members)
+    return {"type": "relation", "id": 1, "members": members, "tags": {"natural": "water"}}
+
+
+def timeIt(label, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    print(f"{label}: {time.perf_counter() - start:.3f}s")
+    return result
+
+
+#%% 1: osmToGeojson with free-node detection on 10^5 - 10^6 elements
+for nrWays in [20_000, 200_000]:
+    data = makeSyntheticOverpassData(nrWays)
+    nrElements = len(data["elements"])
+    geojson = timeIt(f"osmToGeojson(saveFreeNodes=True), {nrElements} elements", o.osmToGeojson, data, saveFreeNodes=True)
+    assert len(geojson["features"]) == 2 * nrWays
+
+#%% 2: assembling multipolygon-relations with many members
+for nrMembers in [10_000, 100_000]:
+    relation = makeSyntheticRelation(nrMembers)
+    feature = timeIt(f"relationToMultiPoly, {nrMembers} members", o.relationToMultiPoly, relation)
+    assert len(feature["geometry"]["coordinates"]) == 1 + 100
+
+#%% 3: memory held by geojson vs. array-backed features
+data = makeSyntheticOverpassData(200_000, nrFreeNodes=0)
+for convert in [o.osmToGeojson, o.osmToFeatureArrays]:
+    tracemalloc.start()
+    features = timeIt(convert.__name__, convert, data)
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{convert.__name__}: {held / 1e6:.1f}MB held, {peak / 1e6:.1f}MB peak")
+    del features
+
+#%% 4: payload-size and parse-time per overpass output-profile (needs network)
+import json
+bbox = {"lonMin": 11.2131, "latMin": 48.0658, "lonMax": 11.3006, "latMax": 48.0916}
+stringifiedBbox = f"{bbox['latMin']},{bbox['lonMin']},{bbox['latMax']},{bbox['lonMax']}"
+client = o.OverpassClient()
+for profile in o.outputProfiles:
+    query = o.makeCombinedQuery(o.defaultLayers, stringifiedBbox, profile)
+    start = time.perf_counter()
+    body = client.fetch(query)
+    fetchTime = time.perf_counter() - start
+    start = time.perf_counter()
+    layers = o.splitIntoLayers(json.loads(body), o.defaultLayers)
+    geojson = {name: o.osmToGeojson(layerData) for name, layerData in layers.items()}
+    parseTime = time.perf_counter() - start
+    nrFeatures = sum(len(g["features"]) for g in geojson.values())
+    print(f"{profile:>4}: {len(body) / 1e6:.2f}MB, fetch {fetchTime:.2f}s, parse {parseTime:.3f}s, {nrFeatures} features")
+
+#%% 5: writing a predicted scene-mask as COG: temp-file copy vs. in-memory
+import os
+import numpy as np
+import rasterio as rio
+import stac as s
+rng = np.random.default_rng(0)
+blobs = (rng.random((3, 40, 60)) > 0.6).astype(np.uint8)
+mask = np.repeat(np.repeat(blobs, 50, axis=1), 50, axis=2)  # (3, 2000, 3000), mask-like large patches
+transform = rio.transform.from_origin(11.0, 48.0, 0.0001, 0.0001)
+for mode in ["copy", "memory"]:
+    targetPath = f"./benchmark_{mode}.tif"
+    timeIt(f"saveToCOG(mode={mode})", s.saveToCOG, targetPath, mask, "EPSG:4326", transform, 0, mode=mode)
+    print(f"{mode}: {os.path.getsize(targetPath) / 1e6:.2f}MB")
+    os.remove(targetPath)
+
+#%% 6: overlapping tile-reads, as in merge.py, with and without block-cache
+rng = np.random.default_rng(0)
+scene = rng.normal(100, 20, (3, 4096, 4096)).clip(0, 255).astype(np.uint8)
+s.saveToCOG("./benchmark_scene.tif", scene, "EPSG:32632", rio.transform.from_origin(600000, 5400000, 10, 10), 0, blockSize=1024, overviewLevels=[])
+
+def readAllTiles(fh, H=256, W=256):
+    for y0 in range(0, fh.height - H, H // 2):
+        for x0 in range(0, fh.width - W, W // 2):
+            s.tifGetPixels(fh, y0, y0 + H - 1, x0, x0 + W - 1)
+
+with rio.open("./benchmark_scene.tif") as fh:
+    timeIt("tiling, plain handle", readAllTiles, fh)
+    cached = s.BlockCacheReader(fh)
+    timeIt("tiling, BlockCacheReader", readAllTiles, cached)
+    print(cached.stats())
+os.remove("./benchmark_scene.tif")
+
+#%% 7: remote window-reads through a RemoteRasterSession, against a local http-server with range-support
+# the server runs in its own process: gdal holds the GIL while it waits for the response
+import re
+import multiprocessing
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    servedBytes = multiprocessing.Value("q", 0)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        rangeHeader = self.headers.get("Range")
+        if rangeHeader is None or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start, end = re.match(r"bytes=(\d+)-(\d*)", rangeHeader).groups()
+        start, end = int(start), min(int(end) if end else size - 1, size - 1)
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(path, "rb") as fh:
+            fh.seek(start)
+            self.wfile.write(fh.read(end - start + 1))
+        with RangeRequestHandler.servedBytes.get_lock():
+            RangeRequestHandler.servedBytes.value += end - start + 1
+        return None
+
+    def log_message(self, *args):
+        pass
+
+s.saveToCOG("./benchmark_remote.tif", scene, "EPSG:32632", rio.transform.from_origin(600000, 5400000, 10, 10), 0, blockSize=512)
+server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+serverProcess = multiprocessing.Process(target=server.serve_forever, daemon=True)
+serverProcess.start()
+href = f"http://127.0.0.1:{server.server_port}/benchmark_remote.tif"
+
+with s.RemoteRasterSession() as session:
+    for i in range(4):
+        with session.handle(href) as fh:
+            timeIt(f"window-read {i}", fh.read, window=rio.windows.Window(1000 * i, 1000 * i, 256, 256))
+    print(f"session: {session.stats()}, {session.bytesPerOpen():.0f} bytes per open")
+print(f"server: {RangeRequestHandler.servedBytes.value} bytes served")
+serverProcess.terminate()
+os.remove("./benchmark_remote.tif")
+
+#%% 8: a tagWhitelist without the layers' filter-keys must not change which layer an element lands in
+square = [{"lat": 0.0, "lon": 0.0}, {"lat": 0.0, "lon": 0.001}, {"lat": 0.001, "lon": 0.001}, {"lat": 0.0, "lon": 0.0}]
+data = {"elements": [
+    {"type": "way", "id": 1, "tags": {"building": "yes", "name": "a"}, "geometry": square},
+    {"type": "way", "id": 2, "tags": {"landuse": "forest", "name": "b"}, "geometry": square},
+    {"type": "way", "id": 3, "tags": {"natural": "water", "name": "c"}, "geometry": square},
+]}
+for tagWhitelist in [None, ["name"], []]:
+    layers = o.splitIntoLayers(data, o.defaultLayers, tagWhitelist)
+    assert {name: [e["id"] for e in l["elements"]] for name, l in layers.items()} == {"buildings": [1], "trees": [2], "water": [3]}
+    if tagWhitelist is not None:
+        assert all(set(e["tags"]) <= set(tagWhitelist) for l in layers.values() for e in l["elements"])
+print("tagWhitelist: layers split correctly")
+
+# %%
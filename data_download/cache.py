@@ -0,0 +1,151 @@
+import os
+import time
+import gzip
+import hashlib
+import threading
+
+
+class DiskCache:
+    """
+        Content-addressed on-disk cache for downloaded responses.
+        - entries are gzip-compressed, one file per key
+        - ttlSeconds: entries older than this are treated as missing
+        - maxSizeBytes: least recently used entries are evicted once the cache grows beyond this size
+        - offline: never fetch; a cache miss raises an exception instead
+        Safe to share between threads.
+
+        An entry's mtime marks when it was written (used for ttl),
+        its atime marks when it was last read (used for lru).
+    """
+
+    def __init__(self, dirPath, maxSizeBytes=2 * 1024**3, ttlSeconds=None, offline=False):
+        self.dirPath = dirPath
+        self.maxSizeBytes = maxSizeBytes
+        self.ttlSeconds = ttlSeconds
+        self.offline = offline
+        self.lock = threading.RLock()
+        os.makedirs(dirPath, exist_ok=True)
+        self.sizeBytes = sum(os.path.getsize(p) for p in self.__entryPaths())
+
+    def makeKey(self, *parts):
+        hasher = hashlib.sha256()
+        for part in parts:
+            hasher.update(str(part).encode("utf-8"))
+            hasher.update(b"\0")
+        return hasher.hexdigest()
+
+    def get(self, key):
+        path = self.__keyToPath(key)
+        with self.lock:
+            if not os.path.exists(path):
+                return None
+            if self.__isExpired(path):
+                self.__delete(path)
+                return None
+            self.__touch(path)
+            with gzip.open(path, "rb") as fh:
+                return fh.read()
+
+    def open(self, key):
+        """
+            Like `get`, but returns a file-handle to the decompressed entry instead of reading it all into memory.
+        """
+        path = self.__keyToPath(key)
+        with self.lock:
+            if not os.path.exists(path):
+                return None
+            if self.__isExpired(path):
+                self.__delete(path)
+                return None
+            self.__touch(path)
+            return gzip.open(path, "rb")
+
+    def put(self, key, data):
+        self.putStream(key, [data])
+
+    def putStream(self, key, chunks):
+        """
+            Like `put`, but takes an iterable of byte-chunks, which are compressed as they arrive.
+        """
+        path = self.__keyToPath(key)
+        tempPath = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with gzip.open(tempPath, "wb") as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+        except BaseException:
+            # e.g. a connection dropping mid-stream: no half-written entry is left behind
+            os.remove(tempPath)
+            raise
+        with self.lock:
+            if os.path.exists(path):
+                self.__delete(path)
+            os.replace(tempPath, path)
+            self.sizeBytes += os.path.getsize(path)
+            if self.sizeBytes > self.maxSizeBytes:
+                self.evict(keep=[key])
+
+    def getOrFetch(self, key, fetch):
+        """
+            Returns cached bytes for `key`, calling `fetch()` and storing its result on a miss.
+        """
+        data = self.get(key)
+        if data is not None:
+            return data
+        if self.offline:
+            raise Exception(f"Cache is in offline mode and has no entry for key '{key}'.")
+        data = fetch()
+        self.put(key, data)
+        return data
+
+    def openOrFetch(self, key, fetchChunks):
+        """
+            Streaming version of `getOrFetch`: `fetchChunks()` returns an iterable of byte-chunks.
+        """
+        fh = self.open(key)
+        if fh is not None:
+            return fh
+        if self.offline:
+            raise Exception(f"Cache is in offline mode and has no entry for key '{key}'.")
+        self.putStream(key, fetchChunks())
+        return self.open(key)
+
+    def evict(self, keep=[]):
+        """
+            Removes expired entries, then least recently used ones until the cache fits into its size-budget.
+            Entries for the keys in `keep` are never evicted.
+        """
+        keepPaths = [self.__keyToPath(key) for key in keep]
+        with self.lock:
+            entries = []
+            for path in self.__entryPaths():
+                if path in keepPaths:
+                    continue
+                if self.__isExpired(path):
+                    self.__delete(path)
+                else:
+                    entries.append((os.stat(path).st_atime_ns, path))
+            entries.sort()
+            for _, path in entries:
+                if self.sizeBytes <= self.maxSizeBytes:
+                    break
+                self.__delete(path)
+
+    def __keyToPath(self, key):
+        return os.path.join(self.dirPath, key + ".gz")
+
+    def __entryPaths(self):
+        return [os.path.join(self.dirPath, f) for f in os.listdir(self.dirPath) if f.endswith(".gz")]
+
+    def __isExpired(self, path):
+        if self.ttlSeconds is None:
+            return False
+        return time.time() - os.stat(path).st_mtime > self.ttlSeconds
+
+    def __touch(self, path):
+        # only updating atime; mtime keeps recording when the entry was written
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+
+    def __delete(self, path):
+        self.sizeBytes -= os.path.getsize(path)
+        os.remove(path)
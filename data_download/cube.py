@@ -0,0 +1,300 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from affine import Affine
+import stac as s
+
+
+def sceneBandFiles(sceneDirPath, bands):
+    """
+        Maps band-names to the files `stac.downloadAndSaveS2Data` saved for one scene, e.g. `<sceneDir>/B02.tif`.
+    """
+    bandFiles = {}
+    for band in bands:
+        filePath = os.path.join(sceneDirPath, band + ".tif")
+        if not os.path.exists(filePath):
+            raise Exception(f"No file for band {band} in {sceneDirPath}")
+        bandFiles[band] = filePath
+    return bandFiles
+
+
+class SceneCube:
+    """
+        Bands of one scene, resampled onto a common grid and stacked into a single (bands, H, W) array on disk.
+        - `<dirPath>/cube.npy`: the data, memory-mapped; reading a tile is plain array-slicing, no decoding
+        - `<dirPath>/cube.json`: band-names, crs, transform and nodata
+        Create with `buildSceneCube`.
+    """
+
+    def __init__(self, dirPath, mode="r"):
+        self.dirPath = dirPath
+        with open(os.path.join(dirPath, "cube.json"), "r") as fh:
+            self.meta = json.load(fh)
+        self.data = np.load(os.path.join(dirPath, "cube.npy"), mmap_mode=mode)
+        self.bands = self.meta["bands"]
+        self.crs = rio.crs.CRS.from_wkt(self.meta["crs"])
+        self.transform = Affine(*self.meta["transform"])
+        self.nodata = self.meta["nodata"]
+        _, self.height, self.width = self.data.shape
+        cloudMaskPath = os.path.join(dirPath, "cloudmask.npy")
+        self.cloudMask = np.load(cloudMaskPath, mmap_mode="r") if os.path.exists(cloudMaskPath) else None
+
+    def grid(self):
+        return self.crs, self.transform, self.height, self.width
+
+    def bandIndices(self, bands):
+        return [self.bands.index(band) for band in bands]
+
+    def tile(self, r0, r1, c0, c1, bands=None):
+        """
+            Pixels [r0, r1) x [c0, c1) - unlike `stac.tifGetPixels` the end-indices are exclusive.
+            bands: list of band-names; None for all.
+        """
+        if bands is None:
+            return self.data[:, r0:r1, c0:c1]
+        return self.data[self.bandIndices(bands), r0:r1, c0:c1]
+
+    def windowTransform(self, r0, c0):
+        return self.transform * Affine.translation(c0, r0)
+
+
+def referenceGrid(bandFiles, referenceBand=None):
+    """
+        (crs, transform, height, width) of `referenceBand`, or else of the band with the finest resolution.
+    """
+    grids = {}
+    for band, filePath in bandFiles.items():
+        with s.readTif(filePath) as fh:
+            grids[band] = (fh.crs, fh.transform, fh.height, fh.width)
+    if referenceBand is None:
+        referenceBand = min(grids, key=lambda band: abs(grids[band][1].a))
+    return grids[referenceBand]
+
+
+def buildSceneCube(bandFiles, cubeDirPath, referenceBand=None, grid=None, dtype=None, nodata=0,
+                   resampling=Resampling.bilinear, categoricalBands=["SCL"], chunkRows=1024, maxWorkers=4):
+    """
+        Resamples the given bands once onto a common grid and writes them into one memory-mapped cube (see `SceneCube`).
+        bandFiles: {bandName: filePath}, in the order the bands should have in the cube.
+                   Files with several bands (like TCI) contribute all of them, named `<band>_1`, `<band>_2`, ...
+        grid: (crs, transform, height, width) to resample onto; by default the grid of `referenceBand`,
+              or else of the band with the finest resolution.
+        categoricalBands: resampled with nearest-neighbour instead of `resampling`, so that classes stay intact.
+        chunkRows: rows resampled at once; bounds the memory needed per band.
+        Bands are processed in parallel, each by its own thread with its own file-handle.
+    """
+    if grid is None:
+        grid = referenceGrid(bandFiles, referenceBand)
+    crs, transform, height, width = grid
+
+    bandNames = []
+    layout = []  # (band, filePath, first cube-index, count)
+    dtypes = []
+    for band, filePath in bandFiles.items():
+        with s.readTif(filePath) as fh:
+            count = fh.count
+            dtypes.append(fh.dtypes[0])
+        layout.append((band, filePath, len(bandNames), count))
+        bandNames += [band] if count == 1 else [f"{band}_{i + 1}" for i in range(count)]
+    if dtype is None:
+        dtype = np.result_type(*dtypes)
+
+    os.makedirs(cubeDirPath, exist_ok=True)
+    data = np.lib.format.open_memmap(
+        os.path.join(cubeDirPath, "cube.npy"), mode="w+", dtype=dtype, shape=(len(bandNames), height, width)
+    )
+
+    def resampleBand(band, filePath, start, count):
+        bandResampling = Resampling.nearest if band in categoricalBands else resampling
+        with s.readTif(filePath) as fh:
+            with WarpedVRT(fh, crs=crs, transform=transform, width=width, height=height,
+                           resampling=bandResampling, nodata=nodata) as vrt:
+                for r0 in range(0, height, chunkRows):
+                    rows = min(chunkRows, height - r0)
+                    chunk = vrt.read(window=Window(0, r0, width, rows))
+                    data[start:start + count, r0:r0 + rows, :] = chunk.astype(dtype, copy=False)
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        futures = [executor.submit(resampleBand, *entry) for entry in layout]
+        for future in futures:
+            future.result()
+    data.flush()
+    del data
+
+    meta = {
+        "bands": bandNames,
+        "sources": {band: os.path.abspath(filePath) for band, filePath in bandFiles.items()},
+        "crs": rio.crs.CRS.from_user_input(crs).to_wkt(),
+        "transform": list(transform)[:6],
+        "nodata": nodata,
+    }
+    with open(os.path.join(cubeDirPath, "cube.json"), "w") as fh:
+        json.dump(meta, fh, indent=4)
+
+    return SceneCube(cubeDirPath)
+
+
+# scene-classification (SCL) classes: cloud shadow, cloud medium / high probability, thin cirrus
+cloudClasses = [3, 8, 9, 10]
+
+
+def sclOnGrid(sclFilePath, grid):
+    """
+        Reads the SCL band resampled (nearest-neighbour) onto `grid` = (crs, transform, height, width).
+    """
+    crs, transform, height, width = grid
+    with s.readTif(sclFilePath) as fh:
+        with WarpedVRT(fh, crs=crs, transform=transform, width=width, height=height,
+                       resampling=Resampling.nearest, nodata=0) as vrt:
+            return vrt.read(1)
+
+
+def cloudMaskFromScl(scl):
+    return np.isin(scl, cloudClasses)
+
+
+def buildCloudMask(cube, sclFilePath=None):
+    """
+        Turns the scene-classification band into a boolean cloud/shadow mask on the cube's grid and
+        stores it next to the cube as `cloudmask.npy`. Uses the cube's own SCL band if it has one.
+    """
+    if "SCL" in cube.bands:
+        scl = cube.tile(0, cube.height, 0, cube.width, ["SCL"])[0]
+    elif sclFilePath is not None:
+        scl = sclOnGrid(sclFilePath, cube.grid())
+    else:
+        raise Exception(f"Cube in {cube.dirPath} has no SCL band, and no SCL file was given.")
+    maskPath = os.path.join(cube.dirPath, "cloudmask.npy")
+    np.save(maskPath, cloudMaskFromScl(scl))
+    cube.cloudMask = np.load(maskPath, mmap_mode="r")
+    return cube.cloudMask
+
+
+def tileCloudFractions(mask, tileRows, tileCols, H, W):
+    """
+        Fraction of cloudy pixels in every tile [y0, y0+H) x [x0, x0+W), for all y0 in tileRows and x0 in tileCols.
+        Returns a (len(tileRows), len(tileCols)) array.
+        The mask is summed once into cells between all tile-edges; an integral image over
+        these cells then gives every tile's sum in constant time.
+    """
+    height, width = mask.shape
+    tileRows = np.asarray(tileRows)
+    tileCols = np.asarray(tileCols)
+    rowEnds = np.minimum(tileRows + H, height)
+    colEnds = np.minimum(tileCols + W, width)
+    rowEdges = np.unique(np.concatenate([[0], tileRows, rowEnds[rowEnds < height]]))
+    colEdges = np.unique(np.concatenate([[0], tileCols, colEnds[colEnds < width]]))
+
+    cellSums = np.add.reduceat(mask, rowEdges, axis=0, dtype=np.int64)
+    cellSums = np.add.reduceat(cellSums, colEdges, axis=1)
+    integral = np.zeros((len(rowEdges) + 1, len(colEdges) + 1), dtype=np.int64)
+    integral[1:, 1:] = cellSums.cumsum(axis=0).cumsum(axis=1)
+
+    # cell-indices of tile-edges; an end at the raster's border maps to the last integral-row/col
+    r0 = np.searchsorted(rowEdges, tileRows)[:, np.newaxis]
+    r1 = np.where(rowEnds < height, np.searchsorted(rowEdges, rowEnds), len(rowEdges))[:, np.newaxis]
+    c0 = np.searchsorted(colEdges, tileCols)[np.newaxis, :]
+    c1 = np.where(colEnds < width, np.searchsorted(colEdges, colEnds), len(colEdges))[np.newaxis, :]
+    sums = integral[r1, c1] - integral[r0, c1] - integral[r1, c0] + integral[r0, c0]
+    areas = (rowEnds - tileRows)[:, np.newaxis] * (colEnds - tileCols)[np.newaxis, :]
+    return sums / areas
+
+
+def nanPercentile(stack, percentile):
+    """
+        Like `np.nanpercentile(stack, percentile, axis=0)` with linear interpolation, but vectorized:
+        numpy's version loops over pixels in python and takes minutes for a single chunk.
+    """
+    stack = np.sort(stack, axis=0)  # nans go last
+    nrValid = np.sum(~np.isnan(stack), axis=0)
+    position = (percentile / 100) * np.maximum(nrValid - 1, 0)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, np.maximum(nrValid - 1, 0))
+    lowerVals = np.take_along_axis(stack, lower[np.newaxis], axis=0)[0]
+    upperVals = np.take_along_axis(stack, upper[np.newaxis], axis=0)[0]
+    return lowerVals + (position - lower) * (upperVals - lowerVals)
+
+
+def buildComposite(scenes, targetFilePath, bands, grid=None, percentile=50, nodata=0, resampling=Resampling.bilinear,
+                   chunkSize=512, maxWorkers=4, **cogOptions):
+    """
+        Per-pixel, cloud-masked median (or other percentile) over several scenes, saved as one COG.
+        scenes: one {bandName: filePath} per scene, each containing `bands` and "SCL" (see `sceneBandFiles`).
+        grid: (crs, transform, height, width) of the composite; by default the grid of the first scene's first band.
+        Pixels that are cloudy (see `cloudClasses`) or nodata in a scene are ignored for that scene;
+        pixels without any clear observation get `nodata`.
+        Works through chunkSize x chunkSize windows, `maxWorkers` at a time, so that only
+        (nrScenes, nrBands, chunkSize, chunkSize) values are held per worker - never the whole time-stack.
+        cogOptions: see `stac.COGWriter`.
+    """
+    if grid is None:
+        grid = referenceGrid({bands[0]: scenes[0][bands[0]]}, bands[0])
+    crs, transform, height, width = grid
+    with s.readTif(scenes[0][bands[0]]) as fh:
+        dtype = fh.dtypes[0]
+
+    windows = [
+        Window(c0, r0, min(chunkSize, width - c0), min(chunkSize, height - r0))
+        for r0 in range(0, height, chunkSize)
+        for c0 in range(0, width, chunkSize)
+    ]
+    handles = threading.local()
+    writeLock = threading.Lock()
+    opened = []     # every file-handle and vrt of every worker-thread, so that they can be closed at the end
+    openedLock = threading.Lock()
+
+    def openVrts():
+        # one warped view per scene and band, opened once per worker-thread
+        vrts = []
+        for scene in scenes:
+            sceneVrts = {}
+            for band in bands + ["SCL"]:
+                fh = s.readTif(scene[band])
+                with openedLock:
+                    opened.append(fh)
+                bandResampling = Resampling.nearest if band == "SCL" else resampling
+                sceneVrts[band] = WarpedVRT(fh, crs=crs, transform=transform, width=width, height=height,
+                                            resampling=bandResampling, nodata=0 if band == "SCL" else nodata)
+                with openedLock:
+                    opened.append(sceneVrts[band])
+            vrts.append(sceneVrts)
+        return vrts
+
+    try:
+        with s.COGWriter(targetFilePath, height, width, len(bands), dtype, crs, transform, nodata, **cogOptions) as writer:
+
+            def compositeChunk(window):
+                if not hasattr(handles, "vrts"):
+                    handles.vrts = openVrts()
+                stack = np.empty((len(scenes), len(bands), window.height, window.width), dtype=np.float32)
+                for t, sceneVrts in enumerate(handles.vrts):
+                    invalid = np.isin(sceneVrts["SCL"].read(1, window=window), cloudClasses + [0])
+                    for b, band in enumerate(bands):
+                        stack[t, b] = sceneVrts[band].read(1, window=window)
+                        stack[t, b][invalid | (stack[t, b] == nodata)] = np.nan
+                # pixels without any clear observation: filled in here, so that numpy does not warn about all-nan slices
+                noObservation = np.isnan(stack).all(axis=0)
+                stack[:, noObservation] = nodata
+                if percentile == 50:
+                    composite = np.nanmedian(stack, axis=0)
+                else:
+                    composite = nanPercentile(stack, percentile)
+                if np.issubdtype(np.dtype(dtype), np.integer):
+                    composite = np.round(composite)
+                with writeLock:
+                    writer.write(composite.astype(dtype), window)
+
+            with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                for _ in executor.map(compositeChunk, windows):
+                    pass
+    finally:
+        for dataset in reversed(opened):
+            dataset.close()
+
+    return targetFilePath
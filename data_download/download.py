@@ -0,0 +1,197 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests as req
+
+
+def getRemoteFileInfo(url, session):
+    """
+        Returns (size, acceptsRanges). size is None if the server does not tell.
+    """
+    try:
+        response = session.head(url, allow_redirects=True, timeout=60)
+        response.raise_for_status()
+    except req.exceptions.RequestException:
+        return None, False
+    size = response.headers.get("Content-Length")
+    size = int(size) if size is not None else None
+    acceptsRanges = response.headers.get("Accept-Ranges", "none").lower() == "bytes"
+    return size, acceptsRanges
+
+
+def fileSha256(filePath, chunkSize=1024**2):
+    hasher = hashlib.sha256()
+    with open(filePath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunkSize), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def loadRanges(rangesPath):
+    """
+        Progress of a parallel download: a list of [position, end] per byte-range,
+        where position is the first byte of the range that has not been written yet.
+    """
+    try:
+        with open(rangesPath, 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def saveRanges(rangesPath, ranges):
+    tempPath = rangesPath + ".tmp"
+    with open(tempPath, 'w') as fh:
+        json.dump(ranges, fh)
+    os.replace(tempPath, rangesPath)
+
+
+def validPrefixSize(partPath, rangesPath):
+    """
+        Number of bytes at the start of `partPath` that are known to be downloaded.
+        A part-file written by parallel range-requests has its full size from the start, with holes in it;
+        only the bytes up to the first unfinished range can be trusted.
+    """
+    if not os.path.exists(partPath):
+        return 0
+    ranges = loadRanges(rangesPath)
+    if ranges is None:
+        return os.path.getsize(partPath)
+    for position, end in sorted(ranges):
+        if position <= end:
+            return position
+    return os.path.getsize(partPath)
+
+
+def downloadRangeInto(url, session, fd, byteRange, chunkSize, maxRetries, onProgress):
+    """
+        Writes bytes byteRange[0]..byteRange[1] (inclusive) of `url` into the open file-descriptor `fd` at the same offsets.
+        byteRange[0] is advanced as chunks are written, and `onProgress()` is called after each chunk.
+        After a dropped connection, continues from the last byte written.
+    """
+    start, end = byteRange
+    for attempt in range(maxRetries + 1):
+        if byteRange[0] > end:
+            return
+        try:
+            headers = {"Range": f"bytes={byteRange[0]}-{end}"}
+            with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise Exception(f"Server ignored range-request for {url}")
+                for chunk in response.iter_content(chunkSize):
+                    os.pwrite(fd, chunk, byteRange[0])
+                    byteRange[0] += len(chunk)
+                    onProgress()
+            if byteRange[0] > end:
+                return
+        except (req.exceptions.ConnectionError, req.exceptions.ChunkedEncodingError, req.exceptions.Timeout):
+            if attempt == maxRetries:
+                raise
+    raise Exception(f"Could not get bytes {start}-{end} of {url}")
+
+
+def downloadInParallel(url, session, partPath, size, nrParts, chunkSize, maxRetries):
+    """
+        Fetches `url` as `nrParts` byte-ranges in parallel into `partPath`.
+        Progress is kept in `<partPath>.ranges`, so that an interrupted run can be resumed.
+    """
+    rangesPath = partPath + ".ranges"
+    ranges = loadRanges(rangesPath) if os.path.exists(partPath) else None
+    if ranges is None or os.path.getsize(partPath) != size:
+        # a part-file from a sequential run holds a contiguous prefix; only the rest needs fetching
+        prefix = validPrefixSize(partPath, rangesPath)
+        if prefix > size:
+            prefix = 0
+        partSize = max(-(-(size - prefix) // nrParts), 1)
+        ranges = [[start, min(start + partSize, size) - 1] for start in range(prefix, size, partSize)]
+    saveRanges(rangesPath, ranges)
+
+    lock = threading.Lock()
+    def onProgress():
+        with lock:
+            saveRanges(rangesPath, ranges)
+
+    fd = os.open(partPath, os.O_RDWR | os.O_CREAT)
+    try:
+        os.ftruncate(fd, size)
+        with ThreadPoolExecutor(max_workers=nrParts) as executor:
+            futures = [
+                executor.submit(downloadRangeInto, url, session, fd, byteRange, chunkSize, maxRetries, onProgress)
+                for byteRange in ranges
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        os.close(fd)
+    os.remove(rangesPath)
+
+
+def downloadSequentially(url, session, partPath, acceptsRanges, chunkSize, maxRetries):
+    """
+        Streams `url` into `partPath`. If `partPath` already holds the start of the file, only the rest is fetched.
+        Without range-support on the server, every retry starts over from the first byte.
+    """
+    rangesPath = partPath + ".ranges"
+    if os.path.exists(rangesPath):
+        # left over from a parallel run: cutting the part-file back to the bytes that are actually there
+        prefix = validPrefixSize(partPath, rangesPath)
+        with open(partPath, 'r+b') as fh:
+            fh.truncate(prefix)
+        os.remove(rangesPath)
+
+    for attempt in range(maxRetries + 1):
+        position = os.path.getsize(partPath) if os.path.exists(partPath) and acceptsRanges else 0
+        headers = {"Range": f"bytes={position}-"} if position > 0 else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 416:
+                    # range not satisfiable: the part-file is already complete
+                    return
+                response.raise_for_status()
+                mode = 'ab' if response.status_code == 206 else 'wb'
+                with open(partPath, mode) as fh:
+                    for chunk in response.iter_content(chunkSize):
+                        fh.write(chunk)
+            return
+        except (req.exceptions.ConnectionError, req.exceptions.ChunkedEncodingError, req.exceptions.Timeout):
+            if attempt == maxRetries:
+                raise
+
+
+def downloadFile(url, targetFilePath, session=None, nrParts=1, expectedSize=None, sha256=None, chunkSize=1024**2, maxRetries=5):
+    """
+        Downloads `url` to `targetFilePath` without ever holding the whole file in memory.
+        - data is streamed in chunks into `<targetFilePath>.part`
+        - a `.part`-file left over from an interrupted run is resumed through an http Range-request
+        - nrParts > 1: fetches that many byte-ranges in parallel (if the server supports ranges);
+          their progress is kept in `<targetFilePath>.part.ranges`
+        - the size (expectedSize, or else the server's Content-Length) and, if given, the sha256-hexdigest
+          are verified before the `.part`-file is atomically renamed to `targetFilePath`
+        Returns `targetFilePath`.
+    """
+    if session is None:
+        session = req.Session()
+    partPath = targetFilePath + ".part"
+
+    size, acceptsRanges = getRemoteFileInfo(url, session)
+    if expectedSize is None:
+        expectedSize = size
+
+    if nrParts > 1 and acceptsRanges and size is not None:
+        downloadInParallel(url, session, partPath, size, nrParts, chunkSize, maxRetries)
+    else:
+        downloadSequentially(url, session, partPath, acceptsRanges, chunkSize, maxRetries)
+
+    actualSize = os.path.getsize(partPath)
+    if expectedSize is not None and actualSize != expectedSize:
+        os.remove(partPath)
+        raise Exception(f"Download of {url} has {actualSize} bytes, expected {expectedSize}.")
+    if sha256 is not None and fileSha256(partPath) != sha256.lower():
+        os.remove(partPath)
+        raise Exception(f"Download of {url} does not match its sha256-checksum.")
+
+    os.replace(partPath, targetFilePath)
+    return targetFilePath
@@ -2,6 +2,8 @@
 import os
 import stac as s
 import osm as o
+import cube as c
+from cache import DiskCache
 import json
 import numpy as np
 import matplotlib.pyplot as plt
@@ -18,6 +20,9 @@ thisDir = os.getcwd()
 assetDir = os.path.join(thisDir, "assets")
 s2Dir = os.path.join(assetDir, "s2")
 outDir = os.path.join(assetDir, "dataset")
+osmCache = DiskCache(os.path.join(assetDir, "osmCache"))
+osmClient = o.OverpassClient(maxConcurrent=2)
+stacCache = DiskCache(os.path.join(assetDir, "stacCache"), ttlSeconds=7 * 24 * 3600)
 os.makedirs(s2Dir, exist_ok=True)
 os.makedirs(outDir, exist_ok=True)
 
@@ -29,95 +34,135 @@ def clamp(start, val, end):
     return val
 
 #%% 1: Download scene
-# s.downloadAndSaveS2Data(s2Dir, bbox, 1, 10, None, False)
+# s.downloadAndSaveS2Data(s2Dir, bbox, 1, 10, None, False, cache=stacCache)
+# with several scenes: one cloud-free median-composite to train on, instead of N cloudy scenes
+# sceneDirs = [os.path.join(s2Dir, d) for d in os.listdir(s2Dir) if os.path.isdir(os.path.join(s2Dir, d))]
+# c.buildComposite([c.sceneBandFiles(d, ["B04", "B03", "B02", "SCL"]) for d in sceneDirs], f"{s2Dir}/composite.tif", ["B04", "B03", "B02"])
 
 #%% 
 fileName = f"{s2Dir}/S2B_32UPU_20230210_0_L2A/TCI.tif"
-fh = s.readTif(fileName)
+# tiles overlap by 50%: caching decoded blocks, so that every block is decoded only once
+fh = s.BlockCacheReader(s.readTif(fileName))
 height, width = s.tifGetPixelRowsCols(fh)
 
 H = 256
 W = 256
 
-i = 0
-I = len(np.arange(0, height-H, H//2)) * len(np.arange(0, width-W, W//2))
-for y0 in np.arange(0, height-H, H//2):
-    for x0 in np.arange(0, width-W, W//2):
-        i+= 1
-
-        # 2: From scene, get subsets and associated bounding-shapes
-        x1 = x0 + W
-        y1 = y0 + H
-        lonBL, latBL = s.tifPixelToLonLat(fh, y1, x0)
-        lonTR, latTR = s.tifPixelToLonLat(fh, y0, x1)
-        bbox = { "lonMin": lonBL, "lonMax": lonTR, "latMin": latBL, "latMax": latTR }
-        print(f"{i}/{I}={100 * i / I}% -- {bbox})")
-
-        # 3: For every subset, get osm-data
-        osmData = o.downloadAndSaveOSM(bbox, None)
-        buildings = osmData["buildings"]
-        trees     = osmData["trees"]
-        water     = osmData["water"]
-    
-
-        # 4: Rasterize osm together with cloud-mask
-        baseData = s.tifGetPixels(fh, y0, y1, x0, x1)
-        _c, _h, _w = baseData.shape
-        paddingC = (0, 0)
-        paddingH = (0, H - _h)
-        paddingW = (0, W - _w)
-        baseDataPadded = np.pad(baseData, [paddingC, paddingH, paddingW], mode='constant', constant_values=0)
-
-        buildingsRaster = o.rasterizeGeojson(buildings, bbox, (H, W))
-        treesRaster     = o.rasterizeGeojson(trees, bbox, (H, W))
-        waterRaster     = o.rasterizeGeojson(water, bbox, (H, W))
-        #  @TODO: cloud mask
-        #                     red              green        blue
-        labelData = np.stack((buildingsRaster, treesRaster, waterRaster))
-        _c, _h, _w = labelData.shape
-        paddingC = (0, 0)
-        paddingH = (0, H - _h)
-        paddingW = (0, W - _w)
-        labelDataPadded = np.pad(labelData, [paddingC, paddingH, paddingW], mode='constant', constant_values=0)
-
-        #5 metadata
-        metadata = {
-            "scene": "S2B_32UPU_20230210_0_L2A",
-            "band": "TCI",
-            "bbox": bbox,
-        }
-
-        # 6: save
-        dataPointDir = os.path.join(outDir, str(i))
-        os.makedirs(dataPointDir)
-
-        with open(os.path.join(dataPointDir, "metadata.json"), 'w') as mdfh:
-            json.dump(metadata, mdfh, indent=4)
-        np.save(os.path.join(dataPointDir, "input.npy"), baseDataPadded, allow_pickle=True)
-        np.save(os.path.join(dataPointDir, "output.npy"), labelDataPadded, allow_pickle=True)
-
-
-        # 7: plot occasionally
-        if i == 1 or i % 100 == 0:
-            plt.figure(figsize=(7, 7))
-            plt.imshow(np.moveaxis(baseDataPadded, 0, -1))
-            plt.imshow(np.moveaxis(labelDataPadded, 0, -1) * 200, alpha=0.25)
-            plt.suptitle(str(metadata["bbox"]))
-            fig = plt.gcf() # getting current figure before it's shown
-            plt.show()
-            fig.savefig(os.path.join(outDir, "..", "datasets_previews", str(i) + ".png"))
+# sparse class-indices as expected by SparseLoader; also used as priorities: water > trees > buildings
+classIds = {"buildings": 1, "trees": 2, "water": 3}
+
+def sparseToRgb(labels):
+    #                      red              green             blue
+    return np.stack((labels == 1, labels == 2, labels == 3), axis=-1) * 200
+
+# 2: Tile-grid and cloud-mask; cloudy tiles are dropped before any osm-work is done for them
+tileRows = np.arange(0, height-H, H//2)
+tileCols = np.arange(0, width-W, W//2)
+maxCloudFraction = 0.1
+sclFileName = f"{s2Dir}/S2B_32UPU_20230210_0_L2A/SCL.tif"
+cloudMask = c.cloudMaskFromScl(c.sclOnGrid(sclFileName, (fh.crs, fh.transform, height, width)))
+np.save(os.path.join(os.path.dirname(sclFileName), "cloudmask.npy"), cloudMask)
+cloudFractions = c.tileCloudFractions(cloudMask, tileRows, tileCols, H, W)
+clearTiles = cloudFractions <= maxCloudFraction
+print(f"{clearTiles.sum()}/{clearTiles.size} tiles have at most {100 * maxCloudFraction}% clouds")
+
+# a scene without any clear tile has nothing to offer: no osm-download, no labels, no tiles
+if not clearTiles.any():
+    print("No tile is clear enough - skipping this scene")
+else:
+    # pixel-extent of all clear tiles; osm is only downloaded and rasterized there
+    clearIy, clearIx = np.nonzero(clearTiles)
+    rMin, rMax = int(tileRows[clearIy].min()), int(min(tileRows[clearIy].max() + H, height))
+    cMin, cMax = int(tileCols[clearIx].min()), int(min(tileCols[clearIx].max() + W, width))
+
+    # 3: Download osm once for the clear part of the scene; tiles are answered from an in-memory index
+    cornerLons, cornerLats = s.tifPixelsToLonLats(fh, [rMin, rMin, rMax, rMax], [cMin, cMax, cMin, cMax])
+    sceneBbox = {
+        "lonMin": float(cornerLons.min()), "lonMax": float(cornerLons.max()),
+        "latMin": float(cornerLats.min()), "latMax": float(cornerLats.max()),
+    }
+    osmIndex = o.OsmSceneIndex(sceneBbox, cache=osmCache, client=osmClient, splits=8)
+
+    # rasterizing labels once for the clear part of the scene, on the tif's own grid; tiles are then just slices
+    layers = [(osmIndex.geometries[name], classId, classId) for name, classId in classIds.items()]
+    clearTransform = fh.window_transform(((rMin, rMax), (cMin, cMax)))
+    sceneLabels = o.rasterizeLayersOnGrid(layers, clearTransform, (rMax - rMin, cMax - cMin), crs=fh.crs)
+
+    # 4: From scene, get subsets and associated bounding-shapes - corners of all tiles in one call
+    Y0, X0 = np.meshgrid(tileRows, tileCols, indexing="ij")
+    lonsBL, latsBL = s.tifPixelsToLonLats(fh, Y0 + H, X0)
+    lonsTR, latsTR = s.tifPixelsToLonLats(fh, Y0, X0 + W)
+
+    i = 0
+    I = len(tileRows) * len(tileCols)
+    nrSaved = 0     # cloudy tiles are skipped, so saved data-points are numbered separately from `i`
+    for iy, y0 in enumerate(tileRows):
+        for ix, x0 in enumerate(tileCols):
+            i+= 1
+            if not clearTiles[iy, ix]:
+                continue
+
+            x1 = x0 + W
+            y1 = y0 + H
+            bbox = {
+                "lonMin": float(lonsBL[iy, ix]), "lonMax": float(lonsTR[iy, ix]),
+                "latMin": float(latsBL[iy, ix]), "latMax": float(latsTR[iy, ix])
+            }
+            print(f"{i}/{I}={100 * i / I}% -- {bbox})")
+
+            # 5: Image-data and labels
+            # tifGetPixels includes its end-indices
+            baseData = s.tifGetPixels(fh, y0, y1 - 1, x0, x1 - 1)
+            _c, _h, _w = baseData.shape
+            paddingC = (0, 0)
+            paddingH = (0, H - _h)
+            paddingW = (0, W - _w)
+            baseDataPadded = np.pad(baseData, [paddingC, paddingH, paddingW], mode='constant', constant_values=0)
+
+            labelData = sceneLabels[y0 - rMin:y1 - rMin, x0 - cMin:x1 - cMin]
+
+            # 6: metadata
+            metadata = {
+                "scene": "S2B_32UPU_20230210_0_L2A",
+                "band": "TCI",
+                "bbox": bbox,
+                "cloudFraction": float(cloudFractions[iy, ix]),
+            }
+
+            # 7: save
+            nrSaved += 1
+            dataPointDir = os.path.join(outDir, str(nrSaved))
+            os.makedirs(dataPointDir)
+
+            with open(os.path.join(dataPointDir, "metadata.json"), 'w') as mdfh:
+                json.dump(metadata, mdfh, indent=4)
+            np.save(os.path.join(dataPointDir, "input.npy"), baseDataPadded, allow_pickle=True)
+            np.save(os.path.join(dataPointDir, "output.npy"), labelData, allow_pickle=True)
+
+
+            # 8: plot occasionally
+            if nrSaved == 1 or nrSaved % 100 == 0:
+                plt.figure(figsize=(7, 7))
+                plt.imshow(np.moveaxis(baseDataPadded, 0, -1))
+                plt.imshow(sparseToRgb(labelData), alpha=0.25)
+                plt.suptitle(str(metadata["bbox"]))
+                fig = plt.gcf() # getting current figure before it's shown
+                plt.show()
+                fig.savefig(os.path.join(outDir, "..", "datasets_previews", str(nrSaved) + ".png"))
+
+print(f"block-cache: {fh.stats()}")
 
 
 # %%
 #
-assetNr = np.random.randint(1, len(os.listdir(outDir)))
+assetNr = np.random.choice(os.listdir(outDir))
 dataIn = np.load(os.path.join(outDir, str(assetNr), "input.npy"), 'r', allow_pickle=True)
 dataOut = np.load(os.path.join(outDir, str(assetNr), "output.npy"), 'r', allow_pickle=True)
 f = open(os.path.join(outDir, str(assetNr), "metadata.json"), 'r')
 metaData = json.load(f)
 plt.figure(figsize=(7, 7))
 plt.imshow(np.moveaxis(dataIn, 0, -1))
-plt.imshow(np.moveaxis(dataOut, 0, -1) * 200, alpha=0.25)
+plt.imshow(sparseToRgb(dataOut), alpha=0.25)
 plt.suptitle(str(metaData)[:50])
 plt.suptitle(str(metaData)[50:])
 # %%
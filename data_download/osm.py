@@ -1,9 +1,21 @@
 import os
+import io
+import re
 import json
+import hashlib
+import time
+import array
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import requests as req
 import rasterio.features as riof
 import rasterio.transform as riot
 import numpy as np
+import shapely
+from shapely.geometry import Polygon, shape
+from shapely.strtree import STRtree
+from pyproj.transformer import Transformer
 
 # Tested with http://overpass-turbo.eu/#
 
@@ -21,8 +33,13 @@ def nodeToPoint(node):
     return point
 
 def nodeToPoly(node):
-    coordinates = [[[e["lon"], e["lat"]] for e in node["geometry"]]]
-    properties = node["tags"] if "tags" in node else {}
+    ring = [[e["lon"], e["lat"]] for e in node.get("geometry", []) if e is not None]
+    if len(ring) < 3:
+        return None
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    coordinates = [ring]
+    properties = dict(node["tags"]) if "tags" in node else {}
     properties["id"] = node["id"]
     return {
         "type": "Feature",
@@ -33,27 +50,115 @@ def nodeToPoly(node):
         "properties" : properties,
     }
 
+def stitchRings(lines):
+    """
+        Joins way-geometries (lists of (lon, lat) tuples) into closed rings.
+        Lines are looked up by their end-points through a hash-index,
+        so stitching runs in near-linear time instead of matching every pair of lines.
+        Lines that cannot be closed into a ring are dropped.
+    """
+    endPointIndex = {}
+    for i, line in enumerate(lines):
+        endPointIndex.setdefault(line[0], []).append(i)
+        endPointIndex.setdefault(line[-1], []).append(i)
+
+    used = [False] * len(lines)
+    rings = []
+    for i, line in enumerate(lines):
+        if used[i]:
+            continue
+        used[i] = True
+        ring = list(line)
+        while ring[0] != ring[-1]:
+            end = ring[-1]
+            candidates = endPointIndex.get(end, [])
+            while len(candidates) > 0 and used[candidates[-1]]:
+                candidates.pop()
+            if len(candidates) == 0:
+                break
+            j = candidates.pop()
+            used[j] = True
+            nextLine = lines[j]
+            if nextLine[0] == end:
+                ring.extend(nextLine[1:])
+            else:
+                ring.extend(reversed(nextLine[:-1]))
+        if ring[0] == ring[-1] and len(ring) >= 4:
+            rings.append(ring)
+    return rings
+
+
+def relationToMultiPoly(relation):
+    """
+        Assembles a multipolygon-relation (as returned by `out geom`) into a (Multi)Polygon feature.
+        Inner rings become holes of the smallest outer ring that contains them entirely.
+    """
+    outerLines = []
+    innerLines = []
+    for member in relation.get("members", []):
+        if member["type"] != "way" or "geometry" not in member:
+            continue
+        line = [(p["lon"], p["lat"]) for p in member["geometry"] if p is not None]
+        if len(line) < 2:
+            continue
+        if member.get("role") == "inner":
+            innerLines.append(line)
+        else:
+            outerLines.append(line)
+
+    outerRings = stitchRings(outerLines)
+    if len(outerRings) == 0:
+        return None
+    polygons = [[ring] for ring in outerRings]
+
+    innerRings = stitchRings(innerLines)
+    if len(innerRings) > 0:
+        outerShapes = [Polygon(ring) for ring in outerRings]
+        tree = STRtree(outerShapes)
+        for ring in innerRings:
+            # the whole inner ring has to lie within the outer one: with nested rings (lake > island > pond)
+            # a single point of the island's hole could just as well fall into the pond
+            containing = tree.query(Polygon(ring), predicate="within")
+            if len(containing) == 0:
+                continue
+            smallest = min(containing, key=lambda k: outerShapes[k].area)
+            polygons[smallest].append(ring)
+
+    coordinates = [[[list(p) for p in ring] for ring in polygon] for polygon in polygons]
+    properties = dict(relation["tags"]) if "tags" in relation else {}
+    properties["id"] = relation["id"]
+    if len(coordinates) == 1:
+        geometry = {"type": "Polygon", "coordinates": coordinates[0]}
+    else:
+        geometry = {"type": "MultiPolygon", "coordinates": coordinates}
+    return {
+        "type": "Feature",
+        "geometry" : geometry,
+        "properties" : properties,
+    }
+
 def osmToGeojson(data, saveFreeNodes=False):
     elements = data["elements"]
 
+    ways = []
+    features = []
     try: 
         ways =  [e for e in elements if e["type"] == "way"]
         polygons = [nodeToPoly(n) for n in ways]
-        features = polygons
+        relations = [e for e in elements if e["type"] == "relation"]
+        multiPolygons = [relationToMultiPoly(r) for r in relations]
+        features = [p for p in polygons + multiPolygons if p is not None]
     except Exception as e:
         print(e)
 
     if saveFreeNodes:
+        # one pass over all ways to collect referenced node-ids,
+        # so that each node can be checked in O(1) instead of against every way
+        referencedNodeIds = set()
+        for way in ways:
+            referencedNodeIds.update(way["nodes"])
         nodes = [e for e in elements if e["type"] == "node"]
-        freeNodes = []
-        for node in nodes:
-            isFreeNode = True
-            for way in ways:
-                if node["id"] in way["nodes"]:
-                    isFreeNode = False
-                    break
-            if isFreeNode:
-                freeNodes.append(node) 
+        freeNodes = [n for n in nodes if n["id"] not in referencedNodeIds]
         freePoints = [nodeToPoint(n) for n in freeNodes]
         features += freePoints
 
@@ -63,85 +168,854 @@ def osmToGeojson(data, saveFreeNodes=False):
     }
     return json
 
-def downloadAndSaveOSM(bbox, saveToDirPath=None, getBuildings=True, getTrees=True, getWater=True):
-    overpass_url = "http://overpass-api.de/api/interpreter"
 
-    lonMin = bbox["lonMin"]
-    latMin = bbox["latMin"]
-    lonMax = bbox["lonMax"]
-    latMax = bbox["latMax"]
-    stringifiedBbox = f"{latMin},{lonMin},{latMax},{lonMax}"
+class FeatureArrays:
+    """
+        Struct-of-arrays collection of (Multi)Polygon features:
+        - coords: (N, 2) float64-buffer holding the vertices (lon, lat) of all features
+        - ringOffsets: ring i spans coords[ringOffsets[i]:ringOffsets[i + 1]]
+        - polygonOffsets: polygon j spans rings polygonOffsets[j]:polygonOffsets[j + 1]; its first ring is the outer one
+        - featureOffsets: feature k spans polygons featureOffsets[k]:featureOffsets[k + 1]
+        - properties: one column per tag-key, None where a feature does not have that tag
+        This is shapely's ragged-array layout for MultiPolygons. Geojson is only produced on demand.
+    """
 
-    buildingQuery = f"""
-        [out:json];     /* output in json format */
-        way[building]( {stringifiedBbox} );
-        (._;>;);        /* get the nodes that make up the ways  */
-        out geom;
+    def __init__(self, coords, ringOffsets, polygonOffsets, featureOffsets, properties):
+        self.coords = coords
+        self.ringOffsets = ringOffsets
+        self.polygonOffsets = polygonOffsets
+        self.featureOffsets = featureOffsets
+        self.properties = properties
+
+    def __len__(self):
+        return len(self.featureOffsets) - 1
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.feature(k)
+
+    def toShapely(self):
+        return shapely.from_ragged_array(
+            shapely.GeometryType.MULTIPOLYGON,
+            self.coords,
+            (self.ringOffsets, self.polygonOffsets, self.featureOffsets)
+        )
+
+    def featureProperties(self, k):
+        return {key: column[k] for key, column in self.properties.items() if column[k] is not None}
+
+    def feature(self, k):
+        polygons = []
+        for j in range(self.featureOffsets[k], self.featureOffsets[k + 1]):
+            rings = []
+            for i in range(self.polygonOffsets[j], self.polygonOffsets[j + 1]):
+                rings.append(self.coords[self.ringOffsets[i]:self.ringOffsets[i + 1]].tolist())
+            polygons.append(rings)
+        if len(polygons) == 1:
+            geometry = {"type": "Polygon", "coordinates": polygons[0]}
+        else:
+            geometry = {"type": "MultiPolygon", "coordinates": polygons}
+        return {
+            "type": "Feature",
+            "geometry" : geometry,
+            "properties" : self.featureProperties(k),
+        }
+
+    def toGeojson(self):
+        return {
+            "type": "FeatureCollection",
+            "features": list(self)
+        }
+
+
+class FeatureArraysBuilder:
+    """
+        Collects features into compact typed buffers, without creating a python-object per vertex.
     """
 
-    treesQuery = f"""
-        [out:json];
-        (
-            way[landuse=forest]( {stringifiedBbox} );
-            way[landuse=meadow]( {stringifiedBbox} );
-            way[landuse=orchard]( {stringifiedBbox} );
-            relation[landuse=forest]( {stringifiedBbox} );  /* also including multi-polyons */
-            relation[landuse=meadow]( {stringifiedBbox} );  /* also including multi-polyons */
-            relation[landuse=orchard]( {stringifiedBbox} );  /* also including multi-polyons */
-        );              /* union of the above statements */
-        (._;>;);
-        out geom;
-    """
-
-    waterQuery = f"""
-        [out:json];
+    def __init__(self):
+        self.coords = array.array('d')
+        self.ringOffsets = array.array('q', [0])
+        self.polygonOffsets = array.array('q', [0])
+        self.featureOffsets = array.array('q', [0])
+        self.columns = {}
+        self.nrFeatures = 0
+
+    def addWay(self, way):
+        geometry = [point for point in way.get("geometry", []) if point is not None]
+        if len(geometry) < 3:
+            return
+        for point in geometry:
+            self.coords.append(point["lon"])
+            self.coords.append(point["lat"])
+        if geometry[0] != geometry[-1]:
+            self.coords.append(geometry[0]["lon"])
+            self.coords.append(geometry[0]["lat"])
+        self.ringOffsets.append(len(self.coords) // 2)
+        self.polygonOffsets.append(len(self.ringOffsets) - 1)
+        self.featureOffsets.append(len(self.polygonOffsets) - 1)
+        self.__addProperties(way.get("tags", {}), way["id"])
+
+    def addPolygons(self, polygons, tags, id):
+        """
+            polygons: list of polygons, each a list of rings, each a list of (lon, lat)
+        """
+        for rings in polygons:
+            for ring in rings:
+                for lon, lat in ring:
+                    self.coords.append(lon)
+                    self.coords.append(lat)
+                self.ringOffsets.append(len(self.coords) // 2)
+            self.polygonOffsets.append(len(self.ringOffsets) - 1)
+        self.featureOffsets.append(len(self.polygonOffsets) - 1)
+        self.__addProperties(tags, id)
+
+    def __addProperties(self, tags, id):
+        k = self.nrFeatures
+        for key, val in list(tags.items()) + [("id", id)]:
+            column = self.columns.setdefault(key, [])
+            column.extend([None] * (k - len(column)))
+            column.append(val)
+        self.nrFeatures += 1
+
+    def build(self):
+        for column in self.columns.values():
+            column.extend([None] * (self.nrFeatures - len(column)))
+        return FeatureArrays(
+            np.frombuffer(self.coords, dtype=np.float64).reshape(-1, 2),
+            np.frombuffer(self.ringOffsets, dtype=np.int64),
+            np.frombuffer(self.polygonOffsets, dtype=np.int64),
+            np.frombuffer(self.featureOffsets, dtype=np.int64),
+            self.columns
+        )
+
+
+def osmToFeatureArrays(data):
+    """
+        Array-backed alternative to `osmToGeojson` for the polygons (ways and multipolygon-relations) in `data`.
+        Free nodes are not included.
+    """
+    builder = FeatureArraysBuilder()
+    for element in data["elements"]:
+        if element["type"] == "way":
+            builder.addWay(element)
+        elif element["type"] == "relation":
+            feature = relationToMultiPoly(element)
+            if feature is None:
+                continue
+            geometry = feature["geometry"]
+            polygons = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+            builder.addPolygons(polygons, element.get("tags", {}), element["id"])
+    return builder.build()
+
+
+overpass_url = "http://overpass-api.de/api/interpreter"
+
+
+def normalizeQuery(query):
+    """
+        Removes comments and redundant whitespace, so that cosmetic edits to a query still hit the cache.
+    """
+    query = re.sub(r"/\*.*?\*/", " ", query, flags=re.DOTALL)
+    query = re.sub(r"\s+", " ", query)
+    query = re.sub(r"\s*([;(),\[\]])\s*", r"\1", query)
+    return query.strip()
+
+
+class OverpassClient:
+    """
+        Thread-safe Overpass client.
+        - re-uses connections through one pooled http-session
+        - never has more than `maxConcurrent` requests in flight
+          (overpass-api.de allows only a few parallel slots per ip)
+        - retries with exponential backoff on 429 (too many requests) and 504 (gateway timeout),
+          and on connections that drop while the body is being read
+    """
+
+    retryStatusCodes = [429, 504]
+    retryExceptions = (req.exceptions.ConnectionError, req.exceptions.ChunkedEncodingError, req.exceptions.Timeout)
+
+    def __init__(self, url=overpass_url, maxConcurrent=2, maxRetries=5, backoffSeconds=2.0, timeoutSeconds=180):
+        self.url = url
+        self.maxConcurrent = maxConcurrent
+        self.maxRetries = maxRetries
+        self.backoffSeconds = backoffSeconds
+        self.timeoutSeconds = timeoutSeconds
+        self.slots = threading.BoundedSemaphore(maxConcurrent)
+        self.session = req.Session()
+        adapter = req.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=maxConcurrent)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch(self, query):
+        for attempt in range(self.maxRetries + 1):
+            response = None
+            try:
+                with self.slots:
+                    response = self.session.get(self.url, params={'data': query}, timeout=self.timeoutSeconds)
+                if response.status_code not in self.retryStatusCodes or attempt == self.maxRetries:
+                    response.raise_for_status()
+                    return response.content
+            except self.retryExceptions:
+                if attempt == self.maxRetries:
+                    raise
+            time.sleep(self.__backoff(response, attempt))
+
+    def stream(self, query, chunkSize=1024**2):
+        """
+            Generator over the chunks of the response-body. Holds a slot until the body has been read.
+            If the connection drops mid-body, the query is sent again and the bytes that were already
+            yielded are skipped - after checking that the new response starts with exactly these bytes.
+        """
+        position = 0                        # bytes yielded so far
+        yieldedHash = hashlib.sha256()      # ... and their hash
+        for attempt in range(self.maxRetries + 1):
+            response = None
+            try:
+                with self.slots:
+                    with self.session.get(self.url, params={'data': query}, timeout=self.timeoutSeconds, stream=True) as response:
+                        if response.status_code not in self.retryStatusCodes or attempt == self.maxRetries:
+                            response.raise_for_status()
+                            resumeAt = position
+                            resumeHash = yieldedHash.digest()
+                            skipped = 0
+                            skippedHash = hashlib.sha256()
+                            for chunk in response.iter_content(chunkSize):
+                                if skipped < resumeAt:
+                                    take = min(len(chunk), resumeAt - skipped)
+                                    skippedHash.update(chunk[:take])
+                                    skipped += take
+                                    if skipped == resumeAt and skippedHash.digest() != resumeHash:
+                                        raise Exception("Overpass-response changed between retries; cannot resume it.")
+                                    chunk = chunk[take:]
+                                    if len(chunk) == 0:
+                                        continue
+                                yieldedHash.update(chunk)
+                                position += len(chunk)
+                                yield chunk
+                            if skipped < resumeAt:
+                                raise Exception("Overpass-response got shorter between retries; cannot resume it.")
+                            return
+            except self.retryExceptions:
+                if attempt == self.maxRetries:
+                    raise
+            time.sleep(self.__backoff(response, attempt))
+
+    def __backoff(self, response, attempt):
+        if response is None:
+            return self.backoffSeconds * 2**attempt
+        retryAfter = response.headers.get("Retry-After")
+        if retryAfter is not None and retryAfter.isdigit():
+            return int(retryAfter)
+        return self.backoffSeconds * 2**attempt
+
+
+defaultClient = OverpassClient()
+
+
+def fetchOverpass(query, stringifiedBbox, cache=None, client=None):
+    if client is None:
+        client = defaultClient
+
+    def fetch():
+        return client.fetch(query)
+
+    if cache is None:
+        return json.loads(fetch())
+
+    key = cache.makeKey(normalizeQuery(query), stringifiedBbox)
+    return json.loads(cache.getOrFetch(key, fetch))
+
+
+class ChunkStream(io.RawIOBase):
+    """
+        Read-only file-like view on an iterable of byte-chunks,
+        so that a response-body can be parsed while it is still downloading.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        # current chunk and read-position in it; a memoryview, so that handing out a part does not copy the rest
+        self.chunk = memoryview(b"")
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset == len(self.chunk):
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.chunk = memoryview(chunk)
+            self.offset = 0
+        n = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:n] = self.chunk[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+
+@contextmanager
+def openOverpassStream(query, stringifiedBbox, cache=None, client=None):
+    """
+        Streaming version of `fetchOverpass`: yields a binary file-handle on the response-body.
+        With a cache, the body is streamed into the cache first and then read back from there.
+    """
+    if client is None:
+        client = defaultClient
+
+    def fetchChunks():
+        return client.stream(query)
+
+    if cache is None:
+        fh = io.BufferedReader(ChunkStream(fetchChunks()))
+    else:
+        key = cache.makeKey(normalizeQuery(query), stringifiedBbox)
+        fh = cache.openOrFetch(key, fetchChunks)
+
+    with fh:
+        yield fh
+
+
+"""
+    Layers are described by a tag-filter table:
+        - types: osm element types to query
+        - tags: every key must be present on an element;
+                None means any value is accepted, a list restricts the accepted values.
+    All layers are fetched through one union query and are split up again on the client.
+"""
+defaultLayers = {
+    "buildings": {
+        "types": ["way"],
+        "tags": {"building": None},
+    },
+    "trees": {
+        "types": ["way", "relation"],   # relations: also including multi-polygons
+        "tags": {"landuse": ["forest", "meadow", "orchard"]},
+    },
+    "water": {
+        "types": ["way", "relation"],
+        "tags": {"natural": ["water"]},
+    },
+}
+
+
+def layerToStatements(layer, stringifiedBbox):
+    tagFilter = ""
+    for key, values in layer["tags"].items():
+        if values is None:
+            tagFilter += f'["{key}"]'
+        else:
+            tagFilter += f'["{key}"~"^({"|".join(values)})$"]'
+    return [f"{elementType}{tagFilter}( {stringifiedBbox} );" for elementType in layer["types"]]
+
+
+"""
+    Output-profiles, i.e. how much the server sends back per element:
+        - full: ways and relations with inline geometry, plus all their member-nodes again as separate elements (legacy)
+        - geom: inline geometry only; member-nodes are not repeated. Roughly halves the payload.
+        - skel: like geom, but without any tags. The query outputs each layer on its own,
+                preceded by a marker-element, so that the client can still tell layers apart.
+    clip: if True, geometries are cut to the bbox on the client, see `clipFeature`.
+          (Overpass' own clipping, `out geom(bbox)`, leaves gaps in ways and relations that cannot be closed into rings again.)
+    Overpass cannot drop tags selectively on the server; a `tagWhitelist` is applied on the client while splitting.
+"""
+outputProfiles = ["full", "geom", "skel"]
+
+
+def makeCombinedQuery(layers, stringifiedBbox, profile="full"):
+    if profile == "skel":
+        blocks = []
+        for name, layer in layers.items():
+            statements = "\n            ".join(layerToStatements(layer, stringifiedBbox))
+            blocks.append(f"""
+        make layer name="{name}"; out;  /* marker: all following elements belong to this layer */
         (
-            way[natural=water]( {stringifiedBbox} );
-            relation[natural=water]( {stringifiedBbox} );
+            {statements}
         );
-        (._;>;);
-        out geom;
+        out skel geom;""")
+        return f"""
+        [out:json];     /* output in json format */{"".join(blocks)}
+    """
+
+    statements = []
+    for layer in layers.values():
+        statements += layerToStatements(layer, stringifiedBbox)
+    statements = "\n            ".join(statements)
+
+    if profile == "full":
+        output = """(._;>;);        /* get the nodes that make up the ways  */
+        out geom;"""
+    elif profile == "geom":
+        output = "out geom;"
+    else:
+        raise Exception(f"Unknown output-profile: '{profile}'. Only know {outputProfiles}.")
+
+    return f"""
+        [out:json];     /* output in json format */
+        (
+            {statements}
+        );              /* union of all layers: one round trip for all of them */
+        {output}
     """
 
+
+def elementMatchesLayer(element, layer):
+    if element["type"] not in layer["types"]:
+        return False
+    tags = element.get("tags", {})
+    for key, values in layer["tags"].items():
+        if key not in tags:
+            return False
+        if values is not None and tags[key] not in values:
+            return False
+    return True
+
+
+def iterLayerElements(elements, layers, tagWhitelist=None):
+    """
+        Generator yielding `(layerName, element)` for every element of a combined query that belongs to a layer.
+        Elements following a layer-marker (see profile "skel") belong to that layer;
+        all other elements are matched against the layers' tag-filters.
+        tagWhitelist: optional list of tag-keys; all other tags are dropped.
+    """
+    markedLayer = None
+    for element in elements:
+        if element["type"] == "layer":
+            markedLayer = element["tags"]["name"]
+            continue
+        # layers are matched on the original tags; only what is yielded is stripped down to the whitelist
+        if markedLayer is not None:
+            yield markedLayer, whitelistTags(element, tagWhitelist)
+            continue
+        for name, layer in layers.items():
+            if elementMatchesLayer(element, layer):
+                yield name, whitelistTags(element, tagWhitelist)
+
+
+def whitelistTags(element, tagWhitelist):
+    if tagWhitelist is None or "tags" not in element:
+        return element
+    element = dict(element)
+    element["tags"] = {key: val for key, val in element["tags"].items() if key in tagWhitelist}
+    return element
+
+
+def splitIntoLayers(data, layers, tagWhitelist=None):
+    """
+        Splits the response of a combined query into one overpass-like response per layer.
+        An element can end up in more than one layer.
+    """
+    layerData = {name: {"elements": []} for name in layers}
+    for name, element in iterLayerElements(data["elements"], layers, tagWhitelist):
+        layerData[name]["elements"].append(element)
+    return layerData
+
+
+def clipFeature(feature, bbox):
+    """
+        Cuts the geometry of `feature` to `bbox`. Returns None if nothing of it lies within the bbox.
+    """
+    geometry = shapely.clip_by_rect(
+        shape(feature["geometry"]), bbox["lonMin"], bbox["latMin"], bbox["lonMax"], bbox["latMax"]
+    )
+    if geometry.is_empty:
+        return None
+    return {
+        "type": "Feature",
+        "geometry": geometry.__geo_interface__,
+        "properties": feature["properties"],
+    }
+
+
+def downloadAndSaveOSM(bbox, saveToDirPath=None, getBuildings=True, getTrees=True, getWater=True, cache=None, client=None, layers=None, fileFormat="geojson", profile="full", clip=False, tagWhitelist=None):
+    """
+        cache: optional `cache.DiskCache`; identical queries on the same bbox are then answered from disk.
+        client: optional `OverpassClient`; defaults to a shared one.
+        layers: optional tag-filter table (see `defaultLayers`). If given, the get* flags are ignored.
+        fileFormat: format of the saved layer-files, one of the keys of `writers`.
+        profile, clip, tagWhitelist: how much data to request and keep, see `outputProfiles`.
+    """
+
+    lonMin = bbox["lonMin"]
+    latMin = bbox["latMin"]
+    lonMax = bbox["lonMax"]
+    latMax = bbox["latMax"]
+    stringifiedBbox = f"{latMin},{lonMin},{latMax},{lonMax}"
+
+    if layers is None:
+        wanted = {"buildings": getBuildings, "trees": getTrees, "water": getWater}
+        layers = {name: layer for name, layer in defaultLayers.items() if wanted[name]}
+
     fullData = {}
+    if len(layers) == 0:
+        return fullData
 
     if saveToDirPath is not None:
         os.makedirs(os.path.join(saveToDirPath, stringifiedBbox), exist_ok=True)
 
-    if getBuildings:
-        response = req.get(overpass_url, params={'data': buildingQuery})
-        data = response.json()
-        geojson = osmToGeojson(data)
-        fullData["buildings"] = geojson
+    query = makeCombinedQuery(layers, stringifiedBbox, profile)
+    data = fetchOverpass(query, stringifiedBbox, cache, client)
+
+    for name, layerData in splitIntoLayers(data, layers, tagWhitelist).items():
+        geojson = osmToGeojson(layerData, saveFreeNodes="node" in layers[name]["types"])
+        if clip:
+            clipped = [clipFeature(feature, bbox) for feature in geojson["features"]]
+            geojson["features"] = [feature for feature in clipped if feature is not None]
+        fullData[name] = geojson
 
         if saveToDirPath is not None:
-            filePath = os.path.join(saveToDirPath, stringifiedBbox, 'buildings.geo.json')
-            with open(filePath, 'w') as fh:
-                json.dump(geojson, fh, indent=4)
+            Writer, extension = writers[fileFormat]
+            with Writer(os.path.join(saveToDirPath, stringifiedBbox, f'{name}{extension}')) as writer:
+                writer.writeAll(geojson["features"])
 
-    if getTrees:
-        response = req.get(overpass_url, params={'data': treesQuery})
-        data = response.json()
-        geojson = osmToGeojson(data)
-        fullData["trees"] = geojson
+    return fullData
 
-        if saveToDirPath is not None:
-            filePath = os.path.join(saveToDirPath, stringifiedBbox, 'trees.geo.json')
-            with open(filePath, 'w') as fh:
-                json.dump(geojson, fh, indent=4)
 
-    if getWater:
-        response = req.get(overpass_url, params={'data': waterQuery})
-        data = response.json()
-        geojson = osmToGeojson(data)
-        fullData["water"] = geojson
+def elementToFeature(element):
+    if element["type"] == "way":
+        return nodeToPoly(element)
+    if element["type"] == "node":
+        return nodeToPoint(element)
+    if element["type"] == "relation":
+        return relationToMultiPoly(element)
+    return None
 
-        if saveToDirPath is not None:
-            filePath = os.path.join(saveToDirPath, stringifiedBbox, 'water.geo.json')
-            with open(filePath, 'w') as fh:
-                json.dump(geojson, fh, indent=4)
 
-    return fullData
+def streamOsmFeatures(stream, layers, tagWhitelist=None):
+    """
+        Generator yielding `(layerName, feature)` while the overpass-response in `stream` is being parsed.
+        Only one element is held in memory at a time, so peak memory does not grow with the size of the area.
+        Unlike `osmToGeojson`, nodes are only returned if a layer asks for them explicitly:
+        detecting free nodes would require all ways to be known beforehand.
+        Requires `ijson`.
+    """
+    import ijson
+
+    elements = ijson.items(stream, "elements.item", use_float=True)
+    for name, element in iterLayerElements(elements, layers, tagWhitelist):
+        feature = elementToFeature(element)
+        if feature is not None:
+            yield name, feature
+
+
+class GeojsonStreamWriter:
+    """
+        Writes a FeatureCollection one feature at a time.
+    """
+
+    def __init__(self, filePath):
+        self.fh = open(filePath, 'w')
+        self.fh.write('{"type": "FeatureCollection", "features": [\n')
+        self.nrFeatures = 0
+
+    def write(self, feature):
+        if self.nrFeatures > 0:
+            self.fh.write(',\n')
+        json.dump(feature, self.fh)
+        self.nrFeatures += 1
+
+    def writeAll(self, features):
+        """
+            features: iterable of features, e.g. a `FeatureArrays`
+        """
+        for feature in features:
+            self.write(feature)
+
+    def close(self):
+        self.fh.write('\n]}\n')
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def mortonCodes(xs, ys, xMin, yMin, xMax, yMax):
+    """
+        Z-order curve positions of the given points, quantized to 16 bit per axis.
+        Sorting by them keeps features that are close in space close in the file.
+    """
+    def spread(v):
+        v = v.astype(np.uint64)
+        v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF)
+        v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F)
+        v = (v | (v << np.uint64(2))) & np.uint64(0x33333333)
+        v = (v | (v << np.uint64(1))) & np.uint64(0x55555555)
+        return v
+    width = max(xMax - xMin, 1e-12)
+    height = max(yMax - yMin, 1e-12)
+    qx = np.clip((xs - xMin) / width * 65535, 0, 65535)
+    qy = np.clip((ys - yMin) / height * 65535, 0, 65535)
+    return spread(qx) | (spread(qy) << np.uint64(1))
+
+
+class GeoParquetWriter:
+    """
+        Writes features into a GeoParquet-file (WKB-geometries, tags as json-strings).
+        Each row also carries its bounding-box in a `bbox` covering-column (GeoParquet 1.1),
+        whose row-group statistics act as a spatial index for `readGeoParquet`.
+        Features are buffered in batches of `sortBatchSize`, sorted along a z-order curve
+        and written in row-groups of `rowGroupSize`, so that each row-group covers a compact area.
+        Requires `pyarrow`.
+    """
+
+    def __init__(self, filePath, rowGroupSize=10000, sortBatchSize=200000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.rowGroupSize = rowGroupSize
+        self.sortBatchSize = sortBatchSize
+        self.buffer = []
+        self.nrFeatures = 0
+        bboxType = pa.struct([("xmin", pa.float64()), ("ymin", pa.float64()), ("xmax", pa.float64()), ("ymax", pa.float64())])
+        geoMetadata = {
+            "version": "1.1.0",
+            "primary_column": "geometry",
+            "columns": {
+                "geometry": {
+                    "encoding": "WKB",
+                    "geometry_types": [],
+                    "covering": {"bbox": {
+                        "xmin": ["bbox", "xmin"], "ymin": ["bbox", "ymin"],
+                        "xmax": ["bbox", "xmax"], "ymax": ["bbox", "ymax"]
+                    }}
+                }
+            }
+        }
+        self.schema = pa.schema(
+            [("bbox", bboxType), ("geometry", pa.binary()), ("properties", pa.string())],
+            metadata={"geo": json.dumps(geoMetadata)}
+        )
+        self.writer = pq.ParquetWriter(filePath, self.schema, compression="zstd")
+
+    def write(self, feature):
+        self.buffer.append(feature)
+        self.nrFeatures += 1
+        if len(self.buffer) >= self.sortBatchSize:
+            self.__flush()
+
+    def writeAll(self, features):
+        """
+            features: iterable of features or `FeatureArrays`, whose geometries are converted in one vectorized call.
+        """
+        if not isinstance(features, FeatureArrays):
+            for feature in features:
+                self.write(feature)
+            return
+        self.__flush()
+        geometries = features.toShapely()
+        for start in range(0, len(features), self.sortBatchSize):
+            end = min(start + self.sortBatchSize, len(features))
+            properties = [features.featureProperties(k) for k in range(start, end)]
+            self.__writeGeometries(geometries[start:end], properties)
+            self.nrFeatures += end - start
+
+    def __flush(self):
+        if len(self.buffer) == 0:
+            return
+        geometries = np.array([shape(f["geometry"]) for f in self.buffer], dtype=object)
+        self.__writeGeometries(geometries, [f["properties"] for f in self.buffer])
+        self.buffer = []
+
+    def __writeGeometries(self, geometries, properties):
+        bounds = shapely.bounds(geometries)
+        codes = mortonCodes(
+            (bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2,
+            bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+        )
+        order = np.argsort(codes, kind="stable")
+        bboxColumn = self.pa.StructArray.from_arrays(
+            [self.pa.array(bounds[order, i]) for i in range(4)],
+            names=["xmin", "ymin", "xmax", "ymax"]
+        )
+        table = self.pa.table({
+            "bbox": bboxColumn,
+            "geometry": self.pa.array(shapely.to_wkb(geometries[order]), type=self.pa.binary()),
+            "properties": self.pa.array([json.dumps(properties[i]) for i in order]),
+        }, schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.rowGroupSize)
+
+    def close(self):
+        self.__flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def readGeoParquet(filePath, bbox=None):
+    """
+        Reads a file written by `GeoParquetWriter` back into a FeatureCollection.
+        If a bbox is given, only row-groups whose statistics overlap it are read from disk,
+        and only features whose bounding-box intersects it are returned.
+        Requires `pyarrow`.
+    """
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(filePath, format="parquet")
+    filter = None
+    if bbox is not None:
+        filter = (
+            (ds.field("bbox", "xmax") >= bbox["lonMin"]) & (ds.field("bbox", "xmin") <= bbox["lonMax"]) &
+            (ds.field("bbox", "ymax") >= bbox["latMin"]) & (ds.field("bbox", "ymin") <= bbox["latMax"])
+        )
+    table = dataset.to_table(columns=["geometry", "properties"], filter=filter)
+
+    geometries = shapely.from_wkb(table.column("geometry").to_numpy(zero_copy_only=False))
+    properties = table.column("properties").to_pylist()
+    features = [
+        {"type": "Feature", "geometry": geometry.__geo_interface__, "properties": json.loads(props)}
+        for geometry, props in zip(geometries, properties)
+    ]
+    return {"type": "FeatureCollection", "features": features}
+
+
+"""
+    Writers for layer-files, by file-format: (writer-class, file-extension).
+    Writers take one feature at a time through `write(feature)`, or many - also as `FeatureArrays` - through `writeAll(features)`,
+    and are finished with `close()`.
+"""
+writers = {
+    "geojson": (GeojsonStreamWriter, ".geo.json"),
+    "parquet": (GeoParquetWriter, ".parquet"),
+}
+
+
+def streamAndSaveOSM(bbox, saveToDirPath, layers=None, cache=None, client=None, fileFormat="geojson", profile="full", clip=False, tagWhitelist=None):
+    """
+        Streaming version of `downloadAndSaveOSM`: features go straight from the http-body into the layer-files.
+        fileFormat: one of the keys of `writers`.
+        profile, clip, tagWhitelist: how much data to request and keep, see `outputProfiles`.
+        Returns the number of features written per layer.
+    """
+    if layers is None:
+        layers = defaultLayers
+
+    lonMin = bbox["lonMin"]
+    latMin = bbox["latMin"]
+    lonMax = bbox["lonMax"]
+    latMax = bbox["latMax"]
+    stringifiedBbox = f"{latMin},{lonMin},{latMax},{lonMax}"
+
+    targetDir = os.path.join(saveToDirPath, stringifiedBbox)
+    os.makedirs(targetDir, exist_ok=True)
+
+    query = makeCombinedQuery(layers, stringifiedBbox, profile)
+    Writer, extension = writers[fileFormat]
+    # writing into `.part`-files, which only get their final names once the whole response has been read:
+    # a writer's footer would otherwise make an interrupted download look like a complete file
+    filePaths = {name: os.path.join(targetDir, f'{name}{extension}') for name in layers}
+    layerWriters = {name: Writer(filePath + ".part") for name, filePath in filePaths.items()}
+    try:
+        with openOverpassStream(query, stringifiedBbox, cache, client) as stream:
+            for name, feature in streamOsmFeatures(stream, layers, tagWhitelist):
+                if clip:
+                    feature = clipFeature(feature, bbox)
+                    if feature is None:
+                        continue
+                layerWriters[name].write(feature)
+    except BaseException:
+        for name, writer in layerWriters.items():
+            writer.close()
+            os.remove(filePaths[name] + ".part")
+        raise
+    for name, writer in layerWriters.items():
+        writer.close()
+        os.replace(filePaths[name] + ".part", filePaths[name])
+
+    return {name: writer.nrFeatures for name, writer in layerWriters.items()}
+
+
+def downloadAndSaveOSMBatch(bboxes, saveToDirPath=None, getBuildings=True, getTrees=True, getWater=True, cache=None, client=None, layers=None, fileFormat="geojson", profile="full", clip=False, tagWhitelist=None):
+    """
+        Concurrent version of `downloadAndSaveOSM` for many bboxes.
+        Concurrency is capped by `client.maxConcurrent`. Results are returned in the order of `bboxes`.
+    """
+    if client is None:
+        client = defaultClient
+
+    with ThreadPoolExecutor(max_workers=client.maxConcurrent) as executor:
+        futures = [
+            executor.submit(
+                downloadAndSaveOSM, bbox, saveToDirPath, getBuildings, getTrees, getWater,
+                cache, client, layers, fileFormat, profile, clip, tagWhitelist
+            )
+            for bbox in bboxes
+        ]
+        return [future.result() for future in futures]
+
+
+class OsmSceneIndex:
+    """
+        Downloads osm-data once for a whole scene and answers per-tile bbox-queries from in-memory STRtrees.
+        splits: the scene-bbox is fetched as a splits x splits grid of concurrent sub-queries,
+                so that no single query runs into overpass' timeout- or size-limits.
+                Elements that show up in more than one sub-query are de-duplicated.
+        profile, tagWhitelist: see `outputProfiles`. Geometries are never clipped, since sub-queries overlap them anyway.
+    """
+
+    def __init__(self, sceneBbox, layers=None, cache=None, client=None, splits=1, profile="geom", tagWhitelist=None):
+        if layers is None:
+            layers = defaultLayers
+        if client is None:
+            client = defaultClient
+
+        lons = np.linspace(sceneBbox["lonMin"], sceneBbox["lonMax"], splits + 1)
+        lats = np.linspace(sceneBbox["latMin"], sceneBbox["latMax"], splits + 1)
+        stringifiedBboxes = [
+            f"{lats[r]},{lons[c]},{lats[r + 1]},{lons[c + 1]}"
+            for r in range(splits) for c in range(splits)
+        ]
+
+        def fetch(stringifiedBbox):
+            query = makeCombinedQuery(layers, stringifiedBbox, profile)
+            return fetchOverpass(query, stringifiedBbox, cache, client)
+
+        layerElements = {name: {} for name in layers}
+        with ThreadPoolExecutor(max_workers=client.maxConcurrent) as executor:
+            for data in executor.map(fetch, stringifiedBboxes):
+                for name, element in iterLayerElements(data["elements"], layers, tagWhitelist):
+                    layerElements[name][(element["type"], element["id"])] = element
+
+        self.features = {}
+        self.geometries = {}
+        self.trees = {}
+        for name, elements in layerElements.items():
+            layerData = {"elements": list(elements.values())}
+            features = osmToGeojson(layerData, saveFreeNodes="node" in layers[name]["types"])["features"]
+            geometries = np.array([shape(f["geometry"]) for f in features], dtype=object)
+            self.features[name] = features
+            self.geometries[name] = geometries
+            self.trees[name] = STRtree(geometries)
+
+    def queryIndices(self, bbox):
+        """
+            Per layer, the indices of all features whose bounding-box intersects `bbox`.
+        """
+        box = shapely.box(bbox["lonMin"], bbox["latMin"], bbox["lonMax"], bbox["latMax"])
+        return {name: np.sort(tree.query(box)) for name, tree in self.trees.items()}
+
+    def query(self, bbox):
+        """
+            Same shape of result as `downloadAndSaveOSM`: one FeatureCollection per layer.
+        """
+        return {
+            name: {"type": "FeatureCollection", "features": [self.features[name][i] for i in indices]}
+            for name, indices in self.queryIndices(bbox).items()
+        }
+
+    def queryGeometries(self, bbox):
+        """
+            Like `query`, but returns arrays of shapely-geometries, which `rasterizeLayers` takes without re-parsing.
+        """
+        return {name: self.geometries[name][indices] for name, indices in self.queryIndices(bbox).items()}
 
 
 # osmData = downloadAndSaveOSM(osmDir, bbox)
@@ -204,3 +1078,78 @@ def rasterizeGeojson(geojson, bbox, imgShape):
     )
     return rasterized
 
+
+def rasterizeFeatures(features, bbox, imgShape, value=1, out=None, chunkSize=10000):
+    """
+        Like `rasterizeGeojson`, but takes any iterable of features - e.g. one produced by `streamOsmFeatures` -
+        and burns them into the raster chunk by chunk, so that they never need to be held in memory all at once.
+    """
+    imgH, imgW = imgShape
+    transform = riot.from_bounds(bbox["lonMin"], bbox["latMin"], bbox["lonMax"], bbox["latMax"], imgW, imgH)
+    if out is None:
+        out = np.zeros(imgShape, dtype=np.uint8)
+
+    chunk = []
+    for feature in features:
+        chunk.append((feature["geometry"], value))
+        if len(chunk) == chunkSize:
+            riof.rasterize(chunk, out=out, all_touched=True, transform=transform)
+            chunk = []
+    if len(chunk) > 0:
+        riof.rasterize(chunk, out=out, all_touched=True, transform=transform)
+
+    return out
+
+
+def rasterizeLayers(layers, bbox, imgShape, out=None):
+    """
+        Burns several layers into one uint8 label-raster in a single call.
+        layers: list of (features, classId, priority). Where layers overlap, the one with the higher priority wins.
+                features: list of geojson-features, `FeatureArrays` or an array of shapely-geometries.
+        out: optional preallocated (H, W) uint8-array; is overwritten. Allows re-using one buffer for all tiles.
+        Geometries are clipped to the bbox before burning.
+        The result holds sparse class-indices (0 = no class), the layout that `SparseLoader` expects.
+    """
+    imgH, imgW = imgShape
+    transform = riot.from_bounds(bbox["lonMin"], bbox["latMin"], bbox["lonMax"], bbox["latMax"], imgW, imgH)
+    return rasterizeLayersOnGrid(layers, transform, imgShape, out=out)
+
+
+def rasterizeLayersOnGrid(layers, transform, imgShape, crs=None, out=None):
+    """
+        Like `rasterizeLayers`, but onto any grid - e.g. a whole scene, given by a tif's own `transform` and `crs`.
+        Geometries are expected in EPSG:4326; if `crs` is given, they are reprojected into it first.
+        Rasterizing a scene once and slicing tiles out of the result is pixel-exact with the tif's own windows,
+        and does not redo work where tiles overlap.
+    """
+    imgH, imgW = imgShape
+    if out is None:
+        out = np.zeros(imgShape, dtype=np.uint8)
+    else:
+        out.fill(0)
+
+    if crs is not None:
+        transformer = Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+        def reproject(coords):
+            x, y = transformer.transform(coords[:, 0], coords[:, 1])
+            return np.column_stack((x, y))
+
+    xMin, yMin, xMax, yMax = riot.array_bounds(imgH, imgW, transform)
+    shapes = []
+    for features, classId, priority in sorted(layers, key=lambda layer: layer[2]):
+        if isinstance(features, np.ndarray):
+            geometries = features
+        elif isinstance(features, FeatureArrays):
+            geometries = features.toShapely()
+        else:
+            geometries = np.array([shape(f["geometry"]) for f in features], dtype=object)
+        if crs is not None:
+            geometries = shapely.transform(geometries, reproject)
+        clipped = shapely.clip_by_rect(geometries, xMin, yMin, xMax, yMax)
+        shapes += [(geometry, classId) for geometry in clipped if not geometry.is_empty]
+
+    if len(shapes) > 0:
+        # shapes are burned in order, so later (= higher priority) ones overwrite earlier ones
+        riof.rasterize(shapes, out=out, all_touched=True, transform=transform)
+
+    return out
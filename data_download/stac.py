@@ -1,14 +1,28 @@
 #%%
 import os
+import re
+import json
+import math
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 import rasterio as rio
 import rasterio.transform as riot
 import rasterio.shutil as rios
+import rasterio.warp as riow
+from rasterio.io import MemoryFile
+from rasterio.windows import Window
 from pyproj.transformer import Transformer
+import shapely
 from shapely.geometry import shape
+import pystac
 from pystac_client import Client
-import requests as req
 import numpy as np
+from download import downloadFile
 
 #%%
 
@@ -57,42 +71,169 @@ def readTif(targetFilePath):
 
 
 def saveToTif(targetFilePath: str, data: np.ndarray, crs: str, transform, noDataVal, extraProps=None):
-    h, w = data.shape
+    """
+        data: (H, W) or (bands, H, W)
+    """
+    if data.ndim == 2:
+        data = data[np.newaxis, :, :]
+    c, h, w = data.shape
     options = {
         'driver': 'GTiff',
         'compress': 'lzw',
         'width': w,
         'height': h,
-        'count': 1,
+        'count': c,
         'dtype': data.dtype,
         'crs': crs, 
         'transform': transform,
         'nodata': noDataVal
     }
     with rio.open(targetFilePath, 'w', **options) as dst:
-        dst.write(data, 1)
+        dst.write(data)
         if extraProps:
             dst.update_tags(**extraProps)
 
 
-def saveToCOG(targetFilePath: str, data: np.ndarray, crs: str, transform, noDataVal, mode="copy", extraProps=None):
-    # two modes for saving - see https://github.com/rasterio/rasterio/issues/2386
-    # copy seems to be safest.
+class COGWriter:
+    """
+        Builds a cloud-optimized geotiff through a tiled and compressed staging-dataset, which is then copied into the COG.
+        The staging-dataset is kept in memory - no temporary file on disk - unless the raw raster is larger than
+        `maxMemoryBytes`; then it goes to `<targetFilePath>_staging.tiff`, so that memory stays bounded for any size.
+        Data can be written all at once or window by window:
+
+            with COGWriter(path, H, W, 3, "uint8", crs, transform) as writer:
+                for r0 in range(0, H, 512):
+                    writer.write(rows, Window(0, r0, W, rows.shape[-2]))
+
+        predictor: 1 (none), 2 (horizontal differencing; good for integers and masks) or 3 (floats)
+        blockSize: side-length of the internal tiles
+        overviewLevels: decimation factors of the overviews; [] for none
+        numThreads: threads gdal uses for compression and overviews; an int or "ALL_CPUS"
+        maxMemoryBytes: largest uncompressed raster that is staged in memory; None to always stage in memory
+    """
+
+    def __init__(self, targetFilePath, height, width, count, dtype, crs, transform, noDataVal=None,
+                 compress="DEFLATE", predictor=2, blockSize=512, overviewLevels=[2, 4, 8],
+                 overviewResampling=rio.enums.Resampling.nearest, numThreads="ALL_CPUS", extraProps=None,
+                 maxMemoryBytes=1024**3):
+        self.targetFilePath = targetFilePath
+        self.compress = compress
+        self.predictor = predictor
+        self.blockSize = blockSize
+        self.overviewLevels = overviewLevels
+        self.overviewResampling = overviewResampling
+        self.numThreads = numThreads
+        self.extraProps = extraProps
+        rawBytes = height * width * count * np.dtype(dtype).itemsize
+        # the staging-dataset is compressed, too, so that it stays well below the size of the raw data.
+        # level 1 costs little extra time over no compression at all.
+        # Poorly compressible data (e.g. float or uint16 reflectances) would still fill up memory, though.
+        options = dict(
+            driver="GTiff",
+            width=width,
+            height=height,
+            count=count,
+            dtype=dtype,
+            crs=crs,
+            transform=transform,
+            nodata=noDataVal,
+            tiled=True,
+            blockxsize=blockSize,
+            blockysize=blockSize,
+            compress="DEFLATE",
+            zlevel=1,
+            num_threads=numThreads,
+            bigtiff="IF_SAFER",
+        )
+        if maxMemoryBytes is None or rawBytes <= maxMemoryBytes:
+            self.memFile = MemoryFile()
+            self.stagingPath = None
+            self.dataset = self.memFile.open(**options)
+        else:
+            self.memFile = None
+            self.stagingPath = targetFilePath + "_staging.tiff"
+            self.dataset = rio.open(self.stagingPath, "w", **options)
+
+    def write(self, data, window=None):
+        """
+            data: (H, W) or (bands, H, W); window: `rasterio.windows.Window` to write into, or None for the whole raster
+        """
+        if data.ndim == 2:
+            data = data[np.newaxis, :, :]
+        self.dataset.write(data, window=window)
+
+    def close(self):
+        if self.dataset is None:
+            return
+        try:
+            with rio.Env(GDAL_NUM_THREADS=str(self.numThreads)):
+                if self.overviewLevels:
+                    self.dataset.build_overviews(self.overviewLevels, self.overviewResampling)
+                if self.extraProps:
+                    self.dataset.update_tags(**self.extraProps)
+                rios.copy(
+                    self.dataset, self.targetFilePath, driver="COG",
+                    COMPRESS=self.compress,
+                    PREDICTOR=self.predictor,
+                    BLOCKSIZE=self.blockSize,
+                    NUM_THREADS=self.numThreads,
+                    OVERVIEWS="FORCE_USE_EXISTING" if self.overviewLevels else "NONE",
+                    BIGTIFF="IF_SAFER",
+                )
+        finally:
+            self.abort()
+
+    def abort(self):
+        """
+            Discards the staging-dataset without writing anything.
+        """
+        if self.dataset is None:
+            return
+        self.dataset.close()
+        self.dataset = None
+        if self.memFile is not None:
+            self.memFile.close()
+        else:
+            os.remove(self.stagingPath)
 
-    if mode == "copy":
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excVal, excTb):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def saveToCOG(targetFilePath: str, data: np.ndarray, crs: str, transform, noDataVal, mode="memory", extraProps=None, **cogOptions):
+    """
+        data: (H, W) or (bands, H, W)
+        cogOptions: predictor, blockSize, overviewLevels, numThreads, ... - see `COGWriter` (mode "memory" only)
+    """
+    # three modes for saving - see https://github.com/rasterio/rasterio/issues/2386
+    # memory builds the COG from an in-memory copy, copy goes through a temporary file on disk.
+    if data.ndim == 2:
+        data = data[np.newaxis, :, :]
+    c, h, w = data.shape
+
+    if mode == "memory":
+        with COGWriter(targetFilePath, h, w, c, data.dtype, crs, transform, noDataVal, extraProps=extraProps, **cogOptions) as writer:
+            writer.write(data)
+
+    elif mode == "copy":
         tempPath = targetFilePath + "_temp.tiff"
         saveToTif(tempPath, data, crs, transform, noDataVal, extraProps)
         rios.copy(tempPath, targetFilePath, driver="COG")
         rios.delete(tempPath)
 
     elif mode == "direct":
-        h, w = data.shape
         options = {
             'driver': 'COG',
             'compress': 'JPEG',
             'width': w,
             'height': h,
-            'count': 1,
+            'count': c,
             'dtype': data.dtype,
             'crs': crs, 
             'transform': transform,
@@ -103,13 +244,13 @@ def saveToCOG(targetFilePath: str, data: np.ndarray, crs: str, transform, noData
             'blockysize': 512,
         }
         with rio.open(targetFilePath, 'w', **options) as dst:
-            dst.write(data, 1)
+            dst.write(data)
             dst.build_overviews([2, 4, 8], rio.enums.Resampling.nearest)
             if extraProps:
                 dst.update_tags(**extraProps)
     
     else:
-        raise Exception(f"Unknown save-mode: '{mode}'. Only know 'copy' and 'direct'.")
+        raise Exception(f"Unknown save-mode: '{mode}'. Only know 'memory', 'copy' and 'direct'.")
     
 
 def tifGetPixelRowsCols(fh):
@@ -118,22 +259,40 @@ def tifGetPixelRowsCols(fh):
     return (h, w)
 
 
+transformerCache = threading.local()
+
+
+def getTransformer(crsFrom, crsTo, alwaysXy=False):
+    """
+        Building a transformer is far more expensive than using it, so they are cached per crs-pair.
+        The cache is per thread, because transformers must not be shared between threads.
+    """
+    keyFrom = crsFrom.to_wkt() if hasattr(crsFrom, "to_wkt") else str(crsFrom)
+    keyTo = crsTo.to_wkt() if hasattr(crsTo, "to_wkt") else str(crsTo)
+    key = (keyFrom, keyTo, alwaysXy)
+    if not hasattr(transformerCache, "transformers"):
+        transformerCache.transformers = {}
+    if key not in transformerCache.transformers:
+        transformerCache.transformers[key] = Transformer.from_crs(crsFrom, crsTo, always_xy=alwaysXy)
+    return transformerCache.transformers[key]
+
+
 def tifGetGeoExtent(fh):
     bounds = fh.bounds
-    coordTransformer = Transformer.from_crs(fh.crs, "EPSG:4326")
+    coordTransformer = getTransformer(fh.crs, "EPSG:4326")
     bounds4326 = coordTransformer.transform_bounds(*bounds)
     return bounds4326
 
 
 def tifPixelToLonLat(fh, r, c):
     x, y = fh.xy(r, c)
-    coordTransformer = Transformer.from_crs(fh.crs, "EPSG:4326")
+    coordTransformer = getTransformer(fh.crs, "EPSG:4326")
     lat, lon = coordTransformer.transform(x, y)
     return lon, lat
 
 
 def tifLonLatToPixel(fh, lon, lat):
-    coordTransformer = Transformer.from_crs("EPSG:4326", fh.crs, always_xy=True)
+    coordTransformer = getTransformer("EPSG:4326", fh.crs, alwaysXy=True)
     # transform: (xx, yy), see: https://pyproj4.github.io/pyproj/stable/api/transformer.html
     coordsTifCrs = coordTransformer.transform(lon, lat)
     # index: (xx, yy), see: https://rasterio.readthedocs.io/en/stable/api/rasterio.io.html#rasterio.io.BufferedDatasetWriter.index
@@ -141,6 +300,33 @@ def tifLonLatToPixel(fh, lon, lat):
     return pixel
 
 
+def tifPixelsToLonLats(fh, rows, cols, offset="center"):
+    """
+        Array-version of `tifPixelToLonLat`: converts whole grids of pixel-coordinates in one call.
+        offset: "center" for pixel-centers (like `fh.xy`), "ul" for the upper-left corners.
+        Returns arrays (lons, lats) of the same shape as `rows` and `cols`.
+    """
+    rows = np.asarray(rows, dtype=np.float64)
+    cols = np.asarray(cols, dtype=np.float64)
+    if offset == "center":
+        rows = rows + 0.5
+        cols = cols + 0.5
+    t = fh.transform
+    xs = t.a * cols + t.b * rows + t.c
+    ys = t.d * cols + t.e * rows + t.f
+    lons, lats = getTransformer(fh.crs, "EPSG:4326", alwaysXy=True).transform(xs, ys)
+    return lons, lats
+
+
+def tifLonLatsToPixels(fh, lons, lats):
+    """
+        Array-version of `tifLonLatToPixel`. Returns integer arrays (rows, cols).
+    """
+    xs, ys = getTransformer("EPSG:4326", fh.crs, alwaysXy=True).transform(np.asarray(lons), np.asarray(lats))
+    cols, rows = ~fh.transform * (xs, ys)
+    return np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64)
+
+
 def tifGetBboxRough(fh, bbox):
     rtl, ctl = tifLonLatToPixel(fh, bbox["lonMin"], bbox["latMax"])
     rtr, ctr = tifLonLatToPixel(fh, bbox["lonMax"], bbox["latMax"])
@@ -171,6 +357,46 @@ def tifGetBboxRough(fh, bbox):
     return pixels, outline
 
 
+def tifGetBboxWindow(fh, bbox, snapToBlocks=True):
+    """
+        Pixel-window covering `bbox` (EPSG:4326).
+        The bbox' outline is sampled densely, because in the tif's crs (e.g. UTM) it is no longer axis-aligned.
+        snapToBlocks: widens the window to the tif's internal block-grid,
+                      so that reading it from a COG takes as few and as small range-requests as possible.
+    """
+    nrSamples = 21
+    lonSamples = np.linspace(bbox["lonMin"], bbox["lonMax"], nrSamples)
+    latSamples = np.linspace(bbox["latMin"], bbox["latMax"], nrSamples)
+    lons = np.concatenate((lonSamples, lonSamples, np.full(nrSamples, bbox["lonMin"]), np.full(nrSamples, bbox["lonMax"])))
+    lats = np.concatenate((np.full(nrSamples, bbox["latMin"]), np.full(nrSamples, bbox["latMax"]), latSamples, latSamples))
+    rows, cols = tifLonLatsToPixels(fh, lons, lats)
+
+    height, width = tifGetPixelRowsCols(fh)
+    r0, r1 = rows.min(), rows.max() + 1
+    c0, c1 = cols.min(), cols.max() + 1
+    if snapToBlocks:
+        blockH, blockW = fh.block_shapes[0]
+        r0 = (r0 // blockH) * blockH
+        c0 = (c0 // blockW) * blockW
+        r1 = math.ceil(r1 / blockH) * blockH
+        c1 = math.ceil(c1 / blockW) * blockW
+    r0, r1 = max(r0, 0), min(r1, height)
+    c0, c1 = max(c0, 0), min(c1, width)
+    if r1 <= r0 or c1 <= c0:
+        raise Exception(f"Bbox {bbox} does not overlap {fh.name}")
+    return rio.windows.Window.from_slices((int(r0), int(r1)), (int(c0), int(c1)))
+
+
+def tifGetBbox(fh, bbox, snapToBlocks=True):
+    """
+        Reads the pixels covering `bbox` (see `tifGetBboxWindow`).
+        Returns (bands, H, W)-data and the affine transform of the window.
+    """
+    window = tifGetBboxWindow(fh, bbox, snapToBlocks)
+    subset = fh.read(window=window)
+    return subset, fh.window_transform(window)
+
+
 def tifGetPixels(fh, r0, r1, c0, c1, channels=None):
     # adding one so that end-index is also included
     window = rio.windows.Window.from_slices(( r0,  r1+1 ), ( c0,  c1+1 ))
@@ -178,6 +404,108 @@ def tifGetPixels(fh, r0, r1, c0, c1, channels=None):
     return subset
 
 
+class BlockCacheReader:
+    """
+        Wraps an open rasterio-handle so that each internal block is decoded only once:
+        decoded blocks are kept in a least-recently-used cache of at most `maxBytes`,
+        and every window is assembled from them. Useful for overlapping reads, like a tiling with 50% overlap.
+        `read` behaves like rasterio's (windows are cropped to the raster), so this can be passed
+        wherever a handle is expected, e.g. to `tifGetPixels`; all other attributes are taken from the handle.
+        Closing the reader (or leaving its `with`-block) closes the handle.
+        Safe to share between threads.
+    """
+
+    def __init__(self, fh, maxBytes=512 * 1024**2):
+        self.fh = fh
+        self.maxBytes = maxBytes
+        self.blockH, self.blockW = fh.block_shapes[0]
+        self.blocks = OrderedDict()
+        self.sizeBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.decodedBytes = 0
+        self.lock = threading.RLock()
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+    # looked up on the type, not the instance - so not covered by `__getattr__`
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excVal, excTb):
+        self.fh.close()
+
+    def read(self, indexes=None, window=None, **kwargs):
+        """
+            indexes: None for all bands, a list of 1-based band-indices, or a single index (returns 2-D data)
+            window: `rasterio.windows.Window` or ((rowStart, rowStop), (colStart, colStop))
+            kwargs: any other keyword of rasterio's `read` (out_shape, masked, boundless, out_dtype, ...);
+                    such reads are passed on to the handle, bypassing the cache.
+        """
+        kwargs = {key: val for key, val in kwargs.items() if val is not None and val is not False}
+        if len(kwargs) > 0:
+            with self.lock:
+                return self.fh.read(indexes, window=window, **kwargs)
+
+        if window is not None and not isinstance(window, Window):
+            window = Window.from_slices(*window)
+        if window is None:
+            r0, r1, c0, c1 = 0, self.fh.height, 0, self.fh.width
+        else:
+            (r0, r1), (c0, c1) = window.toranges()
+            r0, r1 = max(int(r0), 0), min(int(r1), self.fh.height)
+            c0, c1 = max(int(c0), 0), min(int(c1), self.fh.width)
+            r1, c1 = max(r1, r0), max(c1, c0)
+
+        bandIndices = list(range(self.fh.count)) if indexes is None else [i - 1 for i in np.atleast_1d(indexes)]
+        out = np.empty((len(bandIndices), r1 - r0, c1 - c0), dtype=self.fh.dtypes[0])
+        for br in range(r0 // self.blockH, -(-r1 // self.blockH)):
+            for bc in range(c0 // self.blockW, -(-c1 // self.blockW)):
+                block = self.getBlock(br, bc)
+                # overlap of block and window, in raster coordinates
+                br0, bc0 = br * self.blockH, bc * self.blockW
+                y0, y1 = max(r0, br0), min(r1, br0 + block.shape[1])
+                x0, x1 = max(c0, bc0), min(c1, bc0 + block.shape[2])
+                out[:, y0 - r0:y1 - r0, x0 - c0:x1 - c0] = block[bandIndices, y0 - br0:y1 - br0, x0 - bc0:x1 - bc0]
+
+        if indexes is not None and np.ndim(indexes) == 0:
+            return out[0]
+        return out
+
+    def getBlock(self, br, bc):
+        with self.lock:
+            block = self.blocks.get((br, bc))
+            if block is not None:
+                self.blocks.move_to_end((br, bc))
+                self.hits += 1
+                return block
+            self.misses += 1
+            window = Window(bc * self.blockW, br * self.blockH, self.blockW, self.blockH)
+            block = self.fh.read(window=window)
+            self.decodedBytes += block.nbytes
+            self.blocks[(br, bc)] = block
+            self.sizeBytes += block.nbytes
+            while self.sizeBytes > self.maxBytes and len(self.blocks) > 1:
+                _, evicted = self.blocks.popitem(last=False)
+                self.sizeBytes -= evicted.nbytes
+            return block
+
+    def hitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hitRate(),
+            "decodedBytes": self.decodedBytes,
+            "cachedBlocks": len(self.blocks),
+            "cachedBytes": self.sizeBytes,
+        }
+
+
 def tifGetPixelSizeDegrees(fh):
     # return fh.res <-- always returns in units of own coordinate system, which here would be meters
     (lonMin, latMin, lonMax, latMax) = tifGetGeoExtent(fh)
@@ -191,10 +519,9 @@ def tifGetPixelOutline(fh, row, col):
     """
         Verified to work in qgis
     """
-    lonTl, latTl = tifPixelToLonLat(fh, row + 1, col    )
-    lonTr, latTr = tifPixelToLonLat(fh, row + 1, col + 1)
-    lonBr, latBr = tifPixelToLonLat(fh, row,     col + 1)
-    lonBl, latBl = tifPixelToLonLat(fh, row,     col    )
+    lons, lats = tifPixelsToLonLats(fh, [row + 1, row + 1, row, row], [col, col + 1, col + 1, col])
+    lonTl, lonTr, lonBr, lonBl = lons
+    latTl, latTr, latBr, latBl = lats
     w2 = (lonTr - lonTl) / 2
     h2 = (latTr - latBr) / 2
     outline = shape({
@@ -210,9 +537,496 @@ def tifGetPixelOutline(fh, row, col):
     return outline
 
 
-def downloadAndSaveS2Data(saveToDirPath, bbox, maxNrScenes=1, maxCloudCover=10, bands=None, downloadWindowOnly=True):
-    catalog = Client.open("https://earth-search.aws.element84.com/v0")
+def tifGetWindowPixelOutlines(fh, r0, r1, c0, c1, asCoords=False):
+    """
+        Outlines of all pixels in rows r0..r1 and cols c0..c1 (end-indices included, like `tifGetPixels`).
+        All pixel-corners are converted to lon/lat in one call; neighbouring pixels share their corners.
+        Returns a (h, w) array of shapely-polygons,
+        or, if asCoords, a (h, w, 5, 2) float64-array of their closed rings as (lon, lat).
+        Rings are ordered like in `tifGetPixelOutline`, but their corners are projected exactly
+        instead of being shifted by half a pixel in lon/lat, so they differ from it by a tiny fraction of a pixel.
+    """
+    rows = np.arange(r0, r1 + 2)
+    cols = np.arange(c0, c1 + 2)
+    R, C = np.meshgrid(rows, cols, indexing="ij")
+    lons, lats = tifPixelsToLonLats(fh, R, C, offset="ul")
+    corners = np.stack((lons, lats), axis=-1)
+    rings = np.stack((
+        corners[1:, :-1],
+        corners[1:, 1:],
+        corners[:-1, 1:],
+        corners[:-1, :-1],
+        corners[1:, :-1],
+    ), axis=2)
+    if asCoords:
+        return rings
+    h, w = rings.shape[:2]
+    return shapely.polygons(rings.reshape(h * w, 5, 2)).reshape(h, w)
+
+
+def tifIterPixelOutlines(fh, chunkRows=256, asCoords=False):
+    """
+        Generator over the pixel-outlines of a whole tif, chunkRows rows at a time, so that memory stays bounded
+        (the rings of a full 10980x10980 scene would take ~10GB).
+        Yields (r0, r1, outlines) with outlines as returned by `tifGetWindowPixelOutlines`.
+    """
+    height, width = tifGetPixelRowsCols(fh)
+    for r0 in range(0, height, chunkRows):
+        r1 = min(r0 + chunkRows, height) - 1
+        yield r0, r1, tifGetWindowPixelOutlines(fh, r0, r1, 0, width - 1, asCoords)
+
+
+def makeTargetGrid(fh, dstCrs, resolution=None, bbox=None):
+    """
+        Grid (crs, transform, height, width) in `dstCrs` that covers the raster behind `fh` - or only `bbox`, if given.
+        resolution: pixel-size in units of `dstCrs`; by default about the raster's own resolution.
+        With a resolution, the grid is snapped to whole multiples of it, so that grids of different scenes line up.
+    """
+    if bbox is None:
+        bounds = fh.bounds
+        srcCrs = fh.crs
+    else:
+        bounds = (bbox["lonMin"], bbox["latMin"], bbox["lonMax"], bbox["latMax"])
+        srcCrs = "EPSG:4326"
+
+    if resolution is None:
+        transform, width, height = riow.calculate_default_transform(fh.crs, dstCrs, fh.width, fh.height, *fh.bounds)
+        resolution = (transform.a, -transform.e)
+    elif not isinstance(resolution, (tuple, list)):
+        resolution = (resolution, resolution)
+    resX, resY = resolution
+
+    xMin, yMin, xMax, yMax = getTransformer(srcCrs, dstCrs, alwaysXy=True).transform_bounds(*bounds)
+    xMin = math.floor(xMin / resX) * resX
+    yMax = math.ceil(yMax / resY) * resY
+    width = math.ceil((xMax - xMin) / resX)
+    height = math.ceil((yMax - yMin) / resY)
+    return dstCrs, riot.from_origin(xMin, yMax, resX, resY), height, width
+
+
+def reprojectScene(srcFilePath, targetFilePath, grid, resampling=rio.enums.Resampling.bilinear, chunkSize=1024, maxWorkers=4, noDataVal=0, **cogOptions):
+    """
+        Reprojects the raster at `srcFilePath` onto `grid` (crs, transform, height, width; see `makeTargetGrid`)
+        and saves it as COG. Works through chunkSize x chunkSize windows of the target, `maxWorkers` at a time,
+        so memory stays bounded by the chunks in flight (plus the compressed output, for small rasters; see `COGWriter`).
+        Each worker reads through its own file-handle.
+        cogOptions: predictor, blockSize, overviewLevels, ... - see `COGWriter`.
+    """
+    dstCrs, dstTransform, height, width = grid
+    with readTif(srcFilePath) as fh:
+        count = fh.count
+        dtype = fh.dtypes[0]
+        srcNoData = fh.nodata
+
+    windows = [
+        Window(c0, r0, min(chunkSize, width - c0), min(chunkSize, height - r0))
+        for r0 in range(0, height, chunkSize)
+        for c0 in range(0, width, chunkSize)
+    ]
+    handles = threading.local()
+    writeLock = threading.Lock()
+    opened = []     # the file-handles of all worker-threads, so that they can be closed at the end
+    openedLock = threading.Lock()
+
+    try:
+        with COGWriter(targetFilePath, height, width, count, dtype, dstCrs, dstTransform, noDataVal, **cogOptions) as writer:
+
+            def reprojectChunk(window):
+                if not hasattr(handles, "fh"):
+                    handles.fh = readTif(srcFilePath)
+                    with openedLock:
+                        opened.append(handles.fh)
+                chunk = np.full((count, window.height, window.width), noDataVal, dtype=dtype)
+                riow.reproject(
+                    source=rio.band(handles.fh, list(range(1, count + 1))),
+                    destination=chunk,
+                    src_nodata=srcNoData,
+                    dst_transform=rio.windows.transform(window, dstTransform),
+                    dst_crs=dstCrs,
+                    dst_nodata=noDataVal,
+                    resampling=resampling,
+                )
+                with writeLock:
+                    writer.write(chunk, window)
+
+            with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                for _ in executor.map(reprojectChunk, windows):
+                    pass
+    finally:
+        for fh in opened:
+            fh.close()
+
+    return targetFilePath
+
+
+remoteGdalOptions = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",    # no listing of the remote directory on open
+    "GDAL_INGESTED_BYTES_AT_OPEN": 32768,           # one request for the header - S2 COG-headers fit in 32kB
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff,.TIF",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",     # adjacent blocks in one request
+    "GDAL_HTTP_MULTIPLEX": "YES",                    # parallel requests over one http/2 connection
+    "GDAL_HTTP_VERSION": "2",
+    "GDAL_CACHEMAX": 512,                            # MB of decoded blocks
+    "VSI_CACHE": "TRUE",                             # cache of fetched bytes, per handle
+    "VSI_CACHE_SIZE": 64 * 1024**2,
+}
+
+
+class RemoteRasterSession:
+    """
+        Pool of open handles to remote rasters (COGs over http), with gdal tuned for remote reads (see `remoteGdalOptions`).
+        Handles - and with them their header and cached blocks - are kept open and shared between calls,
+        the least recently used ones are closed once there are more than `maxOpen`.
+
+            session = RemoteRasterSession()
+            with session.handle(href) as fh:
+                data = fh.read(window=...)
+
+        Also counts the bytes gdal fetches per href, at open and in total (read from gdal's debug-log).
+        Safe to share between threads; a handle is only used by one thread at a time.
+    """
+
+    # gdal's debug-messages arrive as debug-records on these loggers; while any session tracks bytes,
+    # they are set to DEBUG and do not propagate - only records the application would have seen anyway are passed on.
+    # The last session to close restores their original state.
+    trackedLoggers = ["rasterio._env", "rasterio._err"]
+    nrTracking = 0
+    originalLogStates = {}
+    forwardHandler = None
+    trackingLock = threading.Lock()
+
+    downloadPattern = re.compile(r"Downloading ([\d\-, ]+) \((\S+?)\)")
+
+    def __init__(self, maxOpen=32, gdalOptions=None, trackBytes=True):
+        self.maxOpen = maxOpen
+        self.trackBytes = trackBytes
+        self.gdalOptions = dict(remoteGdalOptions, **(gdalOptions or {}))
+        if trackBytes:
+            self.gdalOptions["CPL_DEBUG"] = "VSICURL"
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+        self.fetched = {}
+        self.logHandler = None
+        if trackBytes:
+            self.__startTracking()
+
+    @contextmanager
+    def handle(self, href):
+        with rio.Env(**self.gdalOptions):
+            entry = self.__acquire(href)
+            try:
+                yield entry["fh"]
+            finally:
+                entry["lock"].release()
+
+    def stats(self):
+        """
+            Per href: number of opens, bytes fetched while opening, and bytes fetched in total.
+        """
+        with self.lock:
+            return {href: dict(counts) for href, counts in self.fetched.items()}
+
+    def bytesPerOpen(self):
+        with self.lock:
+            nrOpens = sum(c["opens"] for c in self.fetched.values())
+            bytesAtOpen = sum(c["bytesAtOpen"] for c in self.fetched.values())
+        return bytesAtOpen / nrOpens if nrOpens > 0 else 0.0
+
+    def close(self):
+        with self.lock:
+            for entry in self.handles.values():
+                entry["fh"].close()
+            self.handles.clear()
+        if self.logHandler is not None:
+            with RemoteRasterSession.trackingLock:
+                for name in RemoteRasterSession.trackedLoggers:
+                    logging.getLogger(name).removeHandler(self.logHandler)
+                self.logHandler = None
+                RemoteRasterSession.nrTracking -= 1
+                if RemoteRasterSession.nrTracking == 0:
+                    for name, (level, propagate, _) in RemoteRasterSession.originalLogStates.items():
+                        logger = logging.getLogger(name)
+                        logger.removeHandler(RemoteRasterSession.forwardHandler)
+                        logger.setLevel(level)
+                        logger.propagate = propagate
+                    RemoteRasterSession.forwardHandler = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excVal, excTb):
+        self.close()
+
+    def __acquire(self, href):
+        """
+            Returns the pool-entry for `href` with its lock held; opens the raster if it is not in the pool.
+        """
+        while True:
+            with self.lock:
+                entry = self.handles.get(href)
+                if entry is None:
+                    entry = {"fh": None, "lock": threading.Lock()}
+                    self.handles[href] = entry
+                self.handles.move_to_end(href)
+            entry["lock"].acquire()
+            # `__evict` may have dropped the entry from the pool between the two locks;
+            # a handle opened into such an entry would never be closed
+            with self.lock:
+                if self.handles.get(href) is entry:
+                    break
+            entry["lock"].release()
+        if entry["fh"] is None or entry["fh"].closed:
+            before = self.__fetchedBytes(href)
+            entry["fh"] = rio.open(href)
+            with self.lock:
+                counts = self.fetched.setdefault(href, {"opens": 0, "bytesAtOpen": 0, "bytes": 0})
+                counts["opens"] += 1
+                counts["bytesAtOpen"] += counts["bytes"] - before
+            self.__evict()
+        return entry
+
+    def __evict(self):
+        with self.lock:
+            for href in list(self.handles.keys()):
+                if len(self.handles) <= self.maxOpen:
+                    break
+                entry = self.handles[href]
+                # handles that are in use right now are skipped
+                if entry["lock"].acquire(blocking=False):
+                    if entry["fh"] is not None:
+                        entry["fh"].close()
+                    del self.handles[href]
+                    entry["lock"].release()
+
+    def __fetchedBytes(self, href):
+        with self.lock:
+            return self.fetched.get(href, {}).get("bytes", 0)
+
+    def __startTracking(self):
+        session = self
+
+        class DownloadLogHandler(logging.Handler):
+            def emit(self, record):
+                match = session.downloadPattern.search(record.getMessage())
+                if match is None:
+                    return
+                ranges, url = match.groups()
+                nrBytes = 0
+                for part in ranges.split(","):
+                    start, end = part.strip().split("-")
+                    nrBytes += int(end) - int(start) + 1
+                href = url[len("/vsicurl/"):] if url.startswith("/vsicurl/") else url
+                with session.lock:
+                    counts = session.fetched.setdefault(href, {"opens": 0, "bytesAtOpen": 0, "bytes": 0})
+                    counts["bytes"] += nrBytes
+
+        class ForwardLogHandler(logging.Handler):
+            # passes on what the tracked loggers would have passed on without tracking
+            def emit(self, record):
+                state = RemoteRasterSession.originalLogStates.get(record.name)
+                if state is None:
+                    return
+                _, propagate, effectiveLevel = state
+                if propagate and record.levelno >= effectiveLevel:
+                    logging.getLogger(record.name).parent.handle(record)
+
+        self.logHandler = DownloadLogHandler(logging.DEBUG)
+        with RemoteRasterSession.trackingLock:
+            if RemoteRasterSession.nrTracking == 0:
+                RemoteRasterSession.forwardHandler = ForwardLogHandler(logging.DEBUG)
+                for name in RemoteRasterSession.trackedLoggers:
+                    logger = logging.getLogger(name)
+                    RemoteRasterSession.originalLogStates[name] = (logger.level, logger.propagate, logger.getEffectiveLevel())
+                    logger.setLevel(logging.DEBUG)
+                    logger.propagate = False
+                    logger.addHandler(RemoteRasterSession.forwardHandler)
+            RemoteRasterSession.nrTracking += 1
+            for name in RemoteRasterSession.trackedLoggers:
+                logging.getLogger(name).addHandler(self.logHandler)
+
+
+class FetchReport:
+    """
+        Thread-safe progress- and throughput-report for a set of asset-fetches.
+    """
+
+    def __init__(self, nrAssets):
+        self.nrAssets = nrAssets
+        self.startTime = time.perf_counter()
+        self.assets = []
+        self.lock = threading.Lock()
+
+    def record(self, itemId, band, nrBytes, seconds, error=None):
+        with self.lock:
+            self.assets.append({
+                "item": itemId,
+                "band": band,
+                "bytes": nrBytes,
+                "seconds": seconds,
+                "error": None if error is None else str(error),
+            })
+            entry = self.assets[-1]
+        print(self.progressLine(entry))
+
+    def elapsedSeconds(self):
+        return time.perf_counter() - self.startTime
+
+    def totalBytes(self):
+        return sum(a["bytes"] for a in self.assets)
 
+    def bytesPerSecond(self):
+        return self.totalBytes() / max(self.elapsedSeconds(), 1e-9)
+
+    def progressLine(self, entry):
+        status = "failed: " + entry["error"] if entry["error"] else f"{entry['bytes'] / 1e6:.1f}MB in {entry['seconds']:.1f}s"
+        return (
+            f"[{len(self.assets)}/{self.nrAssets}] {entry['item']}/{entry['band']} {status} "
+            f"-- total {self.totalBytes() / 1e6:.1f}MB at {self.bytesPerSecond() / 1e6:.2f}MB/s"
+        )
+
+    def summary(self):
+        latencies = [a["seconds"] for a in self.assets if a["error"] is None]
+        return {
+            "nrAssets": self.nrAssets,
+            "nrDone": len(latencies),
+            "nrFailed": len(self.assets) - len(latencies),
+            "bytes": self.totalBytes(),
+            "seconds": self.elapsedSeconds(),
+            "bytesPerSecond": self.bytesPerSecond(),
+            "meanAssetSeconds": float(np.mean(latencies)) if latencies else None,
+            "maxAssetSeconds": float(np.max(latencies)) if latencies else None,
+        }
+
+
+def fetchAssets(tasks, fetch, maxWorkers=8, maxPerHost=4, bandPriority=["TCI"]):
+    """
+        Runs `fetch(task)` for every task concurrently; `fetch` returns the number of bytes it got.
+        tasks: dicts with at least "itemId", "band" and "href".
+        maxPerHost: at most this many fetches run against the same host at once.
+        bandPriority: bands listed here are fetched first, in the given order - e.g. previews like TCI.
+        Returns a `FetchReport`; failed fetches are recorded there instead of aborting the others.
+    """
+    def priority(task):
+        if task["band"] in bandPriority:
+            return bandPriority.index(task["band"])
+        return len(bandPriority)
+    tasks = sorted(tasks, key=priority)  # stable: keeps item-order within a priority
+
+    hostSlots = {}
+    for task in tasks:
+        host = urlparse(task["href"]).netloc
+        hostSlots.setdefault(host, threading.BoundedSemaphore(maxPerHost))
+
+    report = FetchReport(len(tasks))
+
+    def run(task):
+        with hostSlots[urlparse(task["href"]).netloc]:
+            start = time.perf_counter()
+            try:
+                nrBytes = fetch(task)
+                report.record(task["itemId"], task["band"], nrBytes, time.perf_counter() - start)
+            except Exception as e:
+                report.record(task["itemId"], task["band"], 0, time.perf_counter() - start, e)
+
+    # the executor's queue is fifo, so tasks start in priority-order
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        for _ in executor.map(run, tasks):
+            pass
+
+    return report
+
+
+earthSearchUrl = "https://earth-search.aws.element84.com/v0"
+
+
+def stacSearchIndexKey(cache):
+    return cache.makeKey("stac-search-index")
+
+
+def bboxContains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+def itemsFromSupersetSearch(cache, catalogUrl, collections, bbox, query, maxItems):
+    """
+        Answers a search from a cached one with the same collections and query, but a bbox that contains `bbox`.
+        Only searches that were not cut off by their own limit qualify - otherwise items could be missing.
+    """
+    index = json.loads(cache.get(stacSearchIndexKey(cache)) or b"[]")
+    for entry in index:
+        if entry["catalogUrl"] != catalogUrl or entry["collections"] != collections or entry["query"] != query:
+            continue
+        if not entry["complete"] or not bboxContains(entry["bbox"], bbox):
+            continue
+        body = cache.get(entry["key"])
+        if body is None:  # expired
+            continue
+        bboxPoly = shapely.box(*bbox)
+        items = [
+            item for item in json.loads(body)["features"]
+            if shape(item["geometry"]).intersects(bboxPoly)
+        ]
+        return items[:maxItems] if maxItems is not None else items
+    return None
+
+
+def searchStacItems(collections, bbox, query, maxItems, cache=None, catalogUrl=earthSearchUrl):
+    """
+        Runs a STAC search and returns the found items as a list of `pystac.Item`s.
+        bbox: [lonMin, latMin, lonMax, latMax]
+        cache: optional `cache.DiskCache`. Found items are stored as json, so that later runs
+               (or a cache in offline mode) can resolve them and their assets without the network.
+               A search is also answered from an earlier, complete search over a larger bbox.
+    """
+    def fetch():
+        catalog = Client.open(catalogUrl)
+        results = catalog.search(collections=collections, bbox=bbox, max_items=maxItems, query=query)
+        items = [item.to_dict() for item in results.items()]
+        return json.dumps({"type": "FeatureCollection", "features": items}).encode("utf-8")
+
+    if cache is None:
+        itemDicts = json.loads(fetch())["features"]
+        return [pystac.Item.from_dict(d) for d in itemDicts]
+
+    bbox = [float(v) for v in bbox]
+    key = cache.makeKey(catalogUrl, json.dumps(collections), json.dumps(bbox), json.dumps(query, sort_keys=True), maxItems)
+    body = cache.get(key)
+    if body is not None:
+        itemDicts = json.loads(body)["features"]
+        return [pystac.Item.from_dict(d) for d in itemDicts]
+
+    itemDicts = itemsFromSupersetSearch(cache, catalogUrl, collections, bbox, query, maxItems)
+    if itemDicts is not None:
+        return [pystac.Item.from_dict(d) for d in itemDicts]
+
+    body = cache.getOrFetch(key, fetch)
+    itemDicts = json.loads(body)["features"]
+    with cache.lock:
+        indexKey = stacSearchIndexKey(cache)
+        index = json.loads(cache.get(indexKey) or b"[]")
+        index = [entry for entry in index if entry["key"] != key]
+        index.append({
+            "key": key,
+            "catalogUrl": catalogUrl,
+            "collections": collections,
+            "bbox": bbox,
+            "query": query,
+            "complete": maxItems is None or len(itemDicts) < maxItems,
+        })
+        cache.put(indexKey, json.dumps(index).encode("utf-8"))
+    return [pystac.Item.from_dict(d) for d in itemDicts]
+
+
+def downloadAndSaveS2Data(saveToDirPath, bbox, maxNrScenes=1, maxCloudCover=10, bands=None, downloadWindowOnly=True, maxWorkers=8, maxPerHost=4, bandPriority=["TCI"], cache=None, session=None):
+    """
+        downloadWindowOnly: only fetch the block-aligned window around bbox from each COG,
+                            instead of the full 100+MB band-files.
+        maxWorkers, maxPerHost, bandPriority: concurrency and order of the asset-fetches, see `fetchAssets`.
+        cache: optional `cache.DiskCache` for the STAC search, see `searchStacItems`.
+        session: `RemoteRasterSession` the windows are read through; pass one in to share open handles between calls.
+                 Bytes read per open are only reported for a session with trackBytes=True.
+        Returns a `FetchReport`.
+    """
     lonMin = bbox["lonMin"]
     latMin = bbox["latMin"]
     lonMax = bbox["lonMax"]
@@ -226,12 +1040,7 @@ def downloadAndSaveS2Data(saveToDirPath, bbox, maxNrScenes=1, maxCloudCover=10,
         "sentinel:valid_cloud_cover": { "eq": True }  # we want to have the cloud mask in there, too.
     }
 
-    searchResults = catalog.search(
-        collections = collections,
-        bbox        = [lonMin, latMin, lonMax, latMax],
-        max_items   = maxNrScenes,
-        query       = queryParas,
-    )
+    items = searchStacItems(collections, [lonMin, latMin, lonMax, latMax], queryParas, maxNrScenes, cache)
 
     def shouldDownload(key, val):
         if not val.href.endswith('tif'):
@@ -248,22 +1057,34 @@ def downloadAndSaveS2Data(saveToDirPath, bbox, maxNrScenes=1, maxCloudCover=10,
         fullFilePath = os.path.join(targetDir, fileName)
         return fullFilePath
 
-    #  downloading only bbox-subset
-    for item in searchResults.get_items():
-        for key, val in item.assets.items():
-            if shouldDownload(key, val):
-                print(f"Getting {item.id}/{key} ...")
-                with rio.open(val.href) as fh:
-                    if downloadWindowOnly:
-                        subset = tifGetBbox(fh, bbox)
-                        fullFilePath = hrefToDownloadPath(val.href, item.id)
-                        # @TODO: adjust transform to window
-                        saveToTif(fullFilePath, subset, fh.crs, fh.transform, fh.nodata)
-                    else:
-                        fullFilePath = hrefToDownloadPath(val.href, item.id)
-                        response = req.get(val.href)
-                        with open(fullFilePath, 'wb') as tfh:
-                            tfh.write(response.content)  
+    def downloadAsset(task):
+        fullFilePath = hrefToDownloadPath(task["href"], task["itemId"])
+        if downloadWindowOnly:
+            #  downloading only bbox-subset
+            with remoteSession.handle(task["href"]) as fh:
+                subset, windowTransform = tifGetBbox(fh, bbox)
+                crs, noDataVal = fh.crs, fh.nodata
+            saveToTif(fullFilePath, subset, crs, windowTransform, noDataVal)
+        else:
+            downloadFile(task["href"], fullFilePath, nrParts=4)
+        return os.path.getsize(fullFilePath)
+
+    tasks = [
+        {"itemId": item.id, "band": key, "href": val.href}
+        for item in items
+        for key, val in item.assets.items()
+        if shouldDownload(key, val)
+    ]
+    # byte-counting turns on gdal's debug-log, which costs time - only done if the caller asks for it with their own session
+    remoteSession = session if session is not None else RemoteRasterSession(trackBytes=False)
+    try:
+        report = fetchAssets(tasks, downloadAsset, maxWorkers, maxPerHost, bandPriority)
+        if downloadWindowOnly and remoteSession.trackBytes:
+            print(f"Remote reads: {remoteSession.bytesPerOpen() / 1e3:.1f}kB per open")
+    finally:
+        if session is None:
+            remoteSession.close()
+    return report
 
 # downloadAndSaveSatelliteData(s2Dir, "s2", [11, 47, 12, 48], maxNrScenes=4, maxCloudCover=10, bands=None, downloadWindowOnly=False)
 # %%
@@ -60,6 +60,10 @@ class SparseLoader(k.utils.Sequence):
             x[j, :, :, :] = inputData
             outputFile = os.path.join(path, "output.npy")
             outputData = np.load(outputFile, allow_pickle=True)
+            if outputData.ndim == 2:
+                # already sparse class-indices (see `osm.rasterizeLayers`)
+                y[j, :, :] = outputData
+                continue
             C, H, W = outputData.shape
             outputSparse = np.zeros((H, W))
             outputSparse = np.max([outputSparse, outputData[0, :, :] * 1], axis=0) # I think this also works: outputSparse[np.where(outputData[0] == 1)] = 1
@@ -0,0 +1 @@
+../data_download/download.py
\ No newline at end of file
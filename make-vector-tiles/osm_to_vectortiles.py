@@ -32,12 +32,12 @@
 #%% imports
 import os
 import argparse as ap
-import requests as req
 from urllib.parse import urlparse
 import shutil as shu
 
 import mbutil as mb
 from utils import downloadFromUrlTo, replaceInFile
+from download import downloadFile
 
 
 #%% Part 0: directories
@@ -68,9 +68,7 @@ def downloadPbf(dataUrl):
     if os.path.exists(path):
         print(f"Already downloaded {path}.")
         return path
-    response = req.get(dataUrl)
-    with open(path, 'wb') as fh:
-        fh.write(response.content)
+    downloadFile(dataUrl, path, nrParts=4)
     return path
 
 
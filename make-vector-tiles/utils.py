@@ -1,7 +1,8 @@
 import os
 from urllib.parse import urlparse
-import requests as req
 import zipfile as z
+# download.py is a symlink to ../data_download/download.py: one download-engine, shared by both sub-projects
+from download import downloadFile
 
 
 def fileExists(path):
@@ -12,10 +13,8 @@ def fileExists(path):
 def downloadFromUrlTo(url, targetPath):
     os.makedirs(targetPath, exist_ok=True)
     name = urlparse(url).path.split("/").pop()
-    response = req.get(url)
     targetFile = os.path.join(targetPath, name)
-    with open(targetFile, 'wb') as fh:
-        fh.write(response.content)
+    downloadFile(url, targetFile)
     if targetFile.endswith('.zip'):
         unzippedTargetFile = targetFile.strip('.zip')
         with z.ZipFile(targetFile) as zf: